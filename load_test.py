@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+from workflow.loadtest import DEFAULT_CONFIG, run, save_baseline, compare_baseline
+
+CONFIG_FILE_NAME = 'load_test_config.json'
+
+
+def load_config():
+    """ DEFAULT_CONFIG, overridden by load_test_config.json if it exists """
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(CONFIG_FILE_NAME):
+        with open(CONFIG_FILE_NAME, 'r') as f:
+            config.update(json.load(f))
+    return config
+
+
+if __name__ == '__main__':
+    # run, save (the results as the baseline), compare (with the baseline)
+    arg = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if arg not in ('run', 'save', 'compare'):
+        print("Unknown arguments. Valid arguments are 'run', 'save' and 'compare'")
+        sys.exit(2)
+    config = load_config()
+    results = run(config)
+    if arg == 'save':
+        save_baseline(results, config, config['baseline'])
+        print("Baseline saved to %s" % config['baseline'])
+    elif arg == 'compare':
+        regressions = compare_baseline(results, config['baseline'], config['tolerance'])
+        if len(regressions) > 0:
+            print("%d cases regressed" % len(regressions))
+            sys.exit(1)
@@ -1,10 +1,12 @@
 from sklearn.datasets import load_iris
 import boto3
 import uuid
-from decimal import Decimal
 import numpy as np
 import json
+import sys
 import os
+from workflow.bulk import BulkTable, load_columns, data_items
+from workflow.dataset import dataset_path, write_dataset
 
 with open('deploy_config.json', 'r') as f:
     deploy_config = json.load(f)
@@ -14,59 +16,81 @@ with open('task_config.json', 'r') as f:
 task_workspace = os.path.join(deploy_config['workspace_path'], task_config['task_id'])
 HISTORICAL_DATA_IDS_LOC = os.path.join(task_workspace, 'historical_data_ids.txt')
 
+LOCAL = deploy_config.get('backend', 'aws') == 'local'
+if LOCAL:
+    from workflow.local import LocalState
+    local_state = LocalState(task_workspace)
 
-def populate_historical_data(sample_size=200):
-    tbl = boto3.resource('dynamodb', region_name='us-east-2').Table('backtesting-data')
-    X, y = load_iris(return_X_y=True)
+# 'efs' stores the data as a memory-mapped columnar dataset instead of one DynamoDB item per row
+EFS_DATASET = task_config.get('dataset') == 'efs'
 
-    min_X = np.min(X, axis=0)
-    max_X = np.max(X, axis=0)
 
-    data = np.random.uniform(min_X, max_X, [sample_size, 4])
-    ids = []
+def data_table():
+    """ parallel BatchWriteItem/BatchGetItem streams, 'loader_parallelism' in deploy_config.json """
+    parallelism = deploy_config.get('loader_parallelism', 8)
+    if LOCAL:
+        return BulkTable('backtesting-data', 'data_id', parallelism, local_state.dynamo)
+    return BulkTable('backtesting-data', 'data_id', parallelism, boto3.resource('dynamodb', region_name='us-east-2'))
 
-    with tbl.batch_writer() as writer:
-        for i in range(sample_size):
-            x = data[i]
-            data_id = str(uuid.uuid1())
-            writer.put_item(Item={
-                'data_id': data_id,
-                'data': {
-                  'sepal_length': Decimal('%f' % x[0]),
-                  'sepal_width': Decimal('%f' % x[1]),
-                  'petal_length': Decimal('%f' % x[2]),
-                  'petal_width': Decimal('%f' % x[3]),
-                }
-            })
-            ids.append(data_id)
 
+def dataset_location():
+    if LOCAL:
+        return dataset_path(deploy_config['workspace_path'], task_config['task_id'])
+    return dataset_path(deploy_config['ec2_efs_mount_path'], task_config['task_id'])
+
+
+def read_ids():
+    with open(HISTORICAL_DATA_IDS_LOC, 'r') as f:
+        return [i.strip() for i in f.readlines() if i.strip() != '']
+
+
+def populate_historical_data(sample_size=200, source=None):
+    """ load random iris-like rows, or the columns of a CSV/.npy file given as source """
+    if source is None:
+        X, y = load_iris(return_X_y=True)
+        min_X = np.min(X, axis=0)
+        max_X = np.max(X, axis=0)
+        data = np.random.uniform(min_X, max_X, [sample_size, 4])
+        columns = {c: data[:, i] for i, c in enumerate(['sepal_length', 'sepal_width', 'petal_length', 'petal_width'])}
+    else:
+        columns = load_columns(source)
+
+    if EFS_DATASET:
+        ids = [str(uuid.uuid1()) for _ in range(len(next(iter(columns.values()))))]
+        write_dataset(dataset_location(), ids, columns)
+    else:
+        ids, items = data_items(columns)
+        data_table().put_items(items)
+        if LOCAL:
+            local_state.save()
+
+    os.makedirs(task_workspace, exist_ok=True)
     with open(HISTORICAL_DATA_IDS_LOC, 'w') as f:
         f.write('\n'.join(ids))
 
 
 def clean_up_db():
-    with open(HISTORICAL_DATA_IDS_LOC, 'r') as f:
-        ids = f.readlines()
-
-    tbl = boto3.resource('dynamodb', region_name='us-east-2').Table('backtesting-data')
-    with tbl.batch_writer() as batch:
-        for i in ids:
-            batch.delete_item(
-                Key={
-                    'data_id': i
-                }
-            )
+    data_table().delete_items(read_ids())
+    if LOCAL:
+        local_state.save()
 
 
 def read():
-    with open(HISTORICAL_DATA_IDS_LOC, 'r') as f:
-        ids = f.readlines()
-    tbl = boto3.resource('dynamodb', region_name='us-east-2').Table('backtesting-data')
-    for i in ids:
-        r = tbl.get_item(Key={'data_id': i.strip()})
-        print(r['Item'])
+    for item in data_table().get_items(read_ids()):
+        print(item)
 
 
-# populate_historical_data(10000)
-clean_up_db()
-# read()
+if __name__ == '__main__':
+    # populate [sample_size | csv/npy file], cleanup, read
+    arg = sys.argv[1] if len(sys.argv) > 1 else 'cleanup'
+    if arg == 'populate':
+        if len(sys.argv) > 2 and not sys.argv[2].isdigit():
+            populate_historical_data(source=sys.argv[2])
+        else:
+            populate_historical_data(int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    elif arg == 'cleanup':
+        clean_up_db()
+    elif arg == 'read':
+        read()
+    else:
+        print("Unknown arguments. Valid arguments are 'populate [sample_size|file]', 'cleanup' and 'read'")
@@ -1,6 +1,13 @@
 from workflow.trigger import Trigger
 from workflow.deploy import Deploy, DeployItem
 from workflow.reduce import Reducer
+from workflow.dataset import Dataset, dataset_path
+from workflow.bulk import BulkTable
+from workflow.cache import load_cache_keys, cached_data_ids
+from workflow.checkpoint import Checkpoint
+from workflow.sampling import EarlyStop, stratified_order
+from workflow.variants import test_exec_types, exec_types
+from workflow import calibrate
 import json
 import sys
 import os
@@ -11,30 +18,98 @@ with open('task_config.json', 'r') as f:
     task_config = json.load(f)
 
 task_workspace = os.path.join(deploy_config['workspace_path'], task_config['task_id'])
+HISTORICAL_DATA_IDS_LOC = os.path.join(task_workspace, 'historical_data_ids.txt')
+# data ids without a benchmark or test result after 'reduce --harvest', sent again by 'trigger --missing'
+MISSING_DATA_IDS_LOC = os.path.join(task_workspace, 'missing_data_ids.txt')
+
+# early-stop sampling settings (see workflow.sampling.EarlyStop), or None
+SAMPLING = task_config.get('sampling')
+
+# 'local' runs the models in a process pool against in-process stand-ins of the tables and queues
+LOCAL = deploy_config.get('backend', 'aws') == 'local'
+if LOCAL:
+    from workflow.local import LocalState, LocalDeploy, LocalExecutor
+    local_state = LocalState(task_workspace)
 
 
 def run_deploy():
-    deploy = Deploy(deploy_config, task_config)
+    if LOCAL:
+        deploy = LocalDeploy(deploy_config, task_config, local_state)
+    else:
+        deploy = Deploy(deploy_config, task_config)
     deploy.run()
 
 
-def run_trigger():
-    with open(os.path.join(task_workspace, 'historical_data_ids.txt'), 'r') as f:
+def run_trigger(ids_location=HISTORICAL_DATA_IDS_LOC):
+    with open(ids_location, 'r') as f:
         data = f.read()
         data_ids = data.split('\n')
         if '' in data_ids:
             data_ids.remove('')
+    if LOCAL:
+        executor = LocalExecutor(deploy_config, task_config, local_state)
+        executor.run(stratified_order(data_ids, EarlyStop(**SAMPLING).strata) if SAMPLING else data_ids)
+        return
     with open(os.path.join(task_workspace, 'deployed_list.json'), 'r') as f:
         import json
         deployed = json.load(f)
         sqs_queue_urls = [v for k, v in deployed if k == DeployItem.SQS_QUEUE and v.find('_completion') < 0]
 
-    trigger = Trigger()
-    trigger.run(data_ids, sqs_queue_urls)
+    # ids whose benchmark result is already cached are not sent to the benchmark queue
+    cache_key = load_cache_keys(task_workspace).get('benchmark')
+    skip = {}
+    if cache_key is not None:
+        cached = cached_data_ids(BulkTable('backtesting-result', 'result_id'), cache_key, data_ids)
+        print("%d / %d benchmark results are cached" % (len(cached), len(data_ids)))
+        skip = {qu: cached for qu in sqs_queue_urls if qu.endswith('_benchmark')}
+
+    trigger = Trigger(deploy_config.get('trigger_parallelism', 16),
+                      shard_size=deploy_config.get('shard_size', 1),
+                      sample_strata=EarlyStop(**SAMPLING).strata if SAMPLING else None)
+    send(trigger, data_ids, sqs_queue_urls, skip)
+
+
+def send(trigger, data_ids, sqs_queue_urls, skip):
+    """ skip: {queue url: data ids not to send to it} """
+    if task_config.get('dataset') == 'efs':
+        # work messages refer to row ranges of the columnar dataset on EFS
+        dataset = Dataset(dataset_path(deploy_config['ec2_efs_mount_path'], task_config['task_id']))
+        skip = {qu: set(dataset.row_of(i) for i in ids) for qu, ids in skip.items()}
+        if len(data_ids) < len(dataset):
+            # only the rows of the given ids are triggered
+            rows = set(dataset.row_of(i) for i in data_ids)
+            others = set(r for r in range(len(dataset)) if r not in rows)
+            skip = {qu: skip.get(qu, set()) | others for qu in sqs_queue_urls}
+        trigger.run_rows(len(dataset), sqs_queue_urls, skip)
+    else:
+        trigger.run(data_ids, sqs_queue_urls, skip)
+
+
+def run_calibrate(simulate=False):
+    """ measure a sample of the historical data over a grid of Lambda settings and apply the picked ones,
+        simulate: against a latency model instead of the deployed functions (always so for the local backend) """
+    with open(HISTORICAL_DATA_IDS_LOC, 'r') as f:
+        data = f.read()
+        data_ids = data.split('\n')
+        if '' in data_ids:
+            data_ids.remove('')
+    config = dict(calibrate.DEFAULT_CONFIG, **deploy_config.get('calibration', {}))
+    sample_ids = stratified_order(data_ids)[:config['sample_size']]
+    if LOCAL:
+        deploy = LocalDeploy(deploy_config, task_config, local_state)
+    else:
+        deploy = Deploy(deploy_config, task_config)
+    trigger = Trigger(deploy_config.get('trigger_parallelism', 16), shard_size=deploy_config.get('shard_size', 1))
+    calibration = calibrate.Calibration(deploy, config, sample_ids,
+                                        lambda ids, queue_url: send(trigger, ids, [queue_url], {}),
+                                        simulate=simulate or LOCAL)
+    calibration.run(exec_types(task_config))
 
 
-def run_reduce():
-    with open(os.path.join(task_workspace, 'historical_data_ids.txt'), 'r') as f:
+def run_reduce(resume=False, harvest=False):
+    """ resume: continue from the checkpoint of an interrupted reduce instead of starting over,
+        harvest: scan the result table instead of reading the completion queue """
+    with open(HISTORICAL_DATA_IDS_LOC, 'r') as f:
         data = f.read()
         data_ids = data.split('\n')
         if '' in data_ids:
@@ -43,33 +118,71 @@ def run_reduce():
         deployed = json.load(f)
         sqs_queue_urls = [v for k, v in deployed if k == DeployItem.SQS_QUEUE and v.find('_completion') > 0]
 
-    reducer = Reducer(deploy_config, task_config['task_id'], sqs_queue_urls[0], data_ids)
-    reducer.run()
+    cache_key = load_cache_keys(task_workspace).get('benchmark')
+    checkpoint = Checkpoint(os.path.join(task_workspace, 'reduce_checkpoint'))
+    if LOCAL:
+        reducer = Reducer(deploy_config, task_config['task_id'], sqs_queue_urls[0], data_ids,
+                          sqs=local_state.sqs, dynamo=local_state.dynamo, benchmark_cache_key=cache_key,
+                          checkpoint=checkpoint, variants=test_exec_types(task_config))
+        if deploy_config.get('metrics_export', False):
+            reducer.metrics_path = os.path.join(task_workspace, 'reduce_metrics.json')
+        try:
+            reduce(reducer, resume, harvest)
+        finally:
+            local_state.save()
+    else:
+        reducer = Reducer(deploy_config, task_config['task_id'], sqs_queue_urls[0], data_ids,
+                          benchmark_cache_key=cache_key, checkpoint=checkpoint, variants=test_exec_types(task_config))
+        if deploy_config.get('metrics_export', False):
+            reducer.metrics_path = os.path.join(task_workspace, 'reduce_metrics.json')
+        reduce(reducer, resume, harvest)
+
+
+def reduce(reducer, resume, harvest):
+    if SAMPLING:
+        reducer.early_stop = EarlyStop(**SAMPLING)
+        deploy = LocalDeploy(deploy_config, task_config, local_state) if LOCAL else Deploy(deploy_config, task_config)
+        reducer.stop_work = deploy.stop_work
+    if not harvest:
+        reducer.run(resume)
+        return
+    missing = reducer.harvest()
+    with open(MISSING_DATA_IDS_LOC, 'w') as f:
+        f.write('\n'.join(missing))
+    if len(missing) > 0:
+        print("Missing data ids saved to %s, 'trigger --missing' sends them again" % MISSING_DATA_IDS_LOC)
 
 
 def run_cleanup():
-    deploy = Deploy(deploy_config, task_config)
+    if LOCAL:
+        deploy = LocalDeploy(deploy_config, task_config, local_state)
+    else:
+        deploy = Deploy(deploy_config, task_config)
     deploy.clean_up()
 
 
 if __name__ == '__main__':
     if len(sys.argv) < 1:
-        print("Unknown arguments. Valid arguments are 'deploy', 'trigger', 'reduce', 'cleanup' and 'all'")
+        print("Unknown arguments. Valid arguments are 'deploy', 'calibrate', 'trigger', 'reduce', 'cleanup' and 'all'")
         exit(1)
 
     arg = sys.argv[1]
     if arg == 'deploy':
         run_deploy()
     elif arg == 'trigger':
-        run_trigger()
+        run_trigger(MISSING_DATA_IDS_LOC if '--missing' in sys.argv[2:] else HISTORICAL_DATA_IDS_LOC)
+    elif arg == 'calibrate':
+        run_calibrate('--simulate' in sys.argv[2:])
     elif arg == 'reduce':
-        run_reduce()
+        run_reduce('--resume' in sys.argv[2:], '--harvest' in sys.argv[2:])
     elif arg == 'cleanup':
         run_cleanup()
     elif arg == 'all':
         run_deploy()
+        if 'calibration' in deploy_config:
+            run_calibrate()
         run_trigger()
         run_reduce()
         run_cleanup()
     else:
-        print("Unknown arguments. Valid arguments are 'deploy', 'trigger', 'reduce', 'cleanup' and 'all'")
+        print("Unknown arguments. Valid arguments are 'deploy', 'calibrate', 'trigger', 'reduce', 'cleanup' and 'all'")
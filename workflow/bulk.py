@@ -0,0 +1,110 @@
+import time
+import uuid
+import threading
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+
+
+class BulkTable:
+    """Parallel bulk writes, deletes and reads of a DynamoDB table through several
+       BatchWriteItem / BatchGetItem streams, retrying unprocessed items"""
+    MAX_RETRIES = 10
+    # BatchWriteItem takes up to 25 requests, BatchGetItem up to 100 keys
+    WRITE_BATCH_SIZE = 25
+    READ_BATCH_SIZE = 100
+
+    def __init__(self, table_name, key, parallelism=8, dynamo=None):
+        self.table_name = table_name
+        self.key = key
+        self.parallelism = parallelism
+        # injectable stand-in for the boto3 DynamoDB resource (see workflow.local)
+        self.dynamo = dynamo if dynamo is not None else boto3.resource('dynamodb')
+        self.lock = threading.Lock()
+        self.done = 0
+        self.projection = None
+
+    def put_items(self, items):
+        return self.run('Written', self.write_batch,
+                        [{'PutRequest': {'Item': item}} for item in items], BulkTable.WRITE_BATCH_SIZE)
+
+    def delete_items(self, keys):
+        """ segmented delete: the keys are split into batches that are deleted by parallel streams """
+        return self.run('Deleted', self.write_batch,
+                        [{'DeleteRequest': {'Key': {self.key: k}}} for k in dict.fromkeys(keys)], BulkTable.WRITE_BATCH_SIZE)
+
+    def get_items(self, keys, projection=None):
+        """ batch_get_item sweeps over the keys, returns the items found (only the projected attributes if given) """
+        self.projection = projection
+        batches = self.run('Read', self.read_batch, list(dict.fromkeys(keys)), BulkTable.READ_BATCH_SIZE)
+        return [item for items in batches for item in items]
+
+    def run(self, action, func, requests, batch_size):
+        self.done = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            results = list(executor.map(func, [requests[x:x + batch_size] for x in range(0, len(requests), batch_size)]))
+        elapsed = time.time() - start
+        print("")
+        print("%s %d items in %.2f seconds (%.1f items/sec)"
+              % (action, self.done, elapsed, self.done / elapsed if elapsed > 0 else 0))
+        return results
+
+    def write_batch(self, requests):
+        pending = {self.table_name: requests}
+        for attempt in range(BulkTable.MAX_RETRIES):
+            response = self.dynamo.meta.client.batch_write_item(RequestItems=pending)
+            pending = response.get('UnprocessedItems')
+            if not pending:
+                break
+            time.sleep(min(0.05 * (2 ** attempt), 5))
+        if pending:
+            raise RuntimeError('%d items could not be written to %s' % (len(pending[self.table_name]), self.table_name))
+        self.progress(len(requests))
+
+    def read_batch(self, keys):
+        items = []
+        request = {self.table_name: {'Keys': [{self.key: k} for k in keys]}}
+        if self.projection is not None:
+            request[self.table_name]['ProjectionExpression'] = self.projection
+        for attempt in range(BulkTable.MAX_RETRIES):
+            response = self.dynamo.meta.client.batch_get_item(RequestItems=request)
+            items.extend(response['Responses'].get(self.table_name, []))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            time.sleep(min(0.05 * (2 ** attempt), 5))
+        self.progress(len(keys))
+        return items
+
+    def progress(self, n):
+        with self.lock:
+            self.done += n
+            print("%d items processed" % self.done, end='\r')
+
+
+def load_columns(path, names=None):
+    """ columns of a CSV file with a header row, or of a .npy file (structured, or 2-D with names) """
+    if path.endswith('.npy'):
+        data = np.load(path)
+        if data.dtype.names is not None:
+            return {n: data[n].astype(float) for n in data.dtype.names}
+        if names is None:
+            raise ValueError('Column names are required for a 2-D .npy file')
+        return {n: data[:, i].astype(float) for i, n in enumerate(names)}
+    data = np.genfromtxt(path, delimiter=',', names=True)
+    return {n: data[n].astype(float) for n in data.dtype.names}
+
+
+def data_items(columns, ids=None):
+    """ backtesting-data items built from whole columns: values are formatted column by column
+        and converted to Decimal, ids are generated when not given """
+    names = list(columns)
+    n = len(columns[names[0]])
+    if ids is None:
+        ids = [str(uuid.uuid1()) for _ in range(n)]
+    formatted = [np.char.mod('%f', np.asarray(columns[c], dtype=float)).tolist() for c in names]
+    items = [{'data_id': ids[i], 'data': {c: Decimal(formatted[j][i]) for j, c in enumerate(names)}} for i in range(n)]
+    return ids, items
@@ -0,0 +1,47 @@
+"""Content-addressed benchmark results.
+
+A benchmark package is identified by its resolved commit, its library key (interpreter version and resolved
+requirements, see workflow/libstore.py) and its support files. Its results are stored under "cache_<key>_<data_id>" instead of "<task_id>_benchmark_<data_id>",
+so a later task with the same benchmark can reuse them instead of running the model again.
+"""
+import os
+import json
+import hashlib
+
+CACHE_KEYS_FILE_NAME = 'cache_keys.json'
+RESULT_ID_PREFIX = 'cache_'
+
+
+def compute_cache_key(commit, library_key, package_path, file_names=()):
+    h = hashlib.sha256()
+    h.update(commit.encode())
+    h.update(library_key.encode())
+    for name in sorted(file_names):
+        path = os.path.join(package_path, name)
+        h.update(name.encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return '%s-%s' % (commit[:12], h.hexdigest()[:16])
+
+
+def result_id_prefix(task_id, exec_type, cache_key=None):
+    if cache_key:
+        return '%s%s_' % (RESULT_ID_PREFIX, cache_key)
+    return '%s_%s_' % (task_id, exec_type)
+
+
+def load_cache_keys(task_workspace):
+    """ {exec_type: cache key} recorded by Deploy, empty when caching is off """
+    path = os.path.join(task_workspace, CACHE_KEYS_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def cached_data_ids(result_table, cache_key, data_ids):
+    """ the data ids that already have a cached result, result_table is a workflow.bulk.BulkTable """
+    prefix = result_id_prefix(None, None, cache_key)
+    items = result_table.get_items([prefix + i for i in data_ids], projection='result_id, data_id')
+    return set(item['data_id'] for item in items)
@@ -0,0 +1,363 @@
+"""Calibration of the Lambda settings of a task: a stratified sample of the data ids is run through every exec type's
+function once per setting of a grid of memory sizes, batch sizes and concurrency limits, and the setting with the
+lowest cost per record among those nearly as fast as the fastest one is kept for the full run.
+
+The billed duration of an invocation is estimated from the handler's stage timings (the completion messages of one
+invocation share its request id), cold starts are left out as they amortize over a full run. A simulated mode runs
+the same search against a latency model instead of Lambda, for testing offline.
+"""
+import os
+import json
+import math
+import time
+import random
+import itertools
+
+from workflow.cache import load_cache_keys, result_id_prefix
+from workflow.reduce import Reducer
+
+CALIBRATION_FILE_NAME = 'calibration.json'
+# a simulated calibration is never picked up by a deploy
+SIMULATED_FILE_NAME = 'calibration_simulated.json'
+
+DEFAULT_CONFIG = {
+    'memory_sizes': [1024, 2048, 3008],
+    'batch_sizes': [1, 10],
+    # null is the account's unreserved concurrency, limits go from 2 to 1000
+    'concurrencies': [10, 50],
+    'batching_window': 0,
+    'sample_size': 500,
+    # seconds to wait for the sample under one setting
+    'sample_timeout': 600,
+    # the cheapest setting with at least this share of the best throughput is picked
+    'throughput_share': 0.8,
+    # optional records/sec the full run needs, and bound of the 95th percentile seconds per record
+    'min_throughput': None,
+    'max_record_seconds': None,
+    # x86 prices per GB-second and per request
+    'gb_second_price': 0.0000166667,
+    'request_price': 0.0000002,
+    'simulation': {}
+}
+
+# Lambda gets one full vCPU at this memory size, the CPU share scales with memory below it
+FULL_VCPU_MEMORY = 1769
+# the function timeout covers the slowest invocation of the sample this many times over
+TIMEOUT_MARGIN = 3
+MAX_TIMEOUT = 900
+# AWS recommends a work queue visibility timeout of six times the function timeout
+VISIBILITY_TIMEOUT_FACTOR = 6
+# purge_queue takes up to a minute, messages sent meanwhile may be deleted too
+PURGE_SECONDS = 60
+
+
+def load_settings(task_workspace):
+    """ {exec_type: settings} picked by the last calibration run of the task, empty without one """
+    path = os.path.join(task_workspace, CALIBRATION_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return {exec_type: c['settings'] for exec_type, c in json.load(f).items()}
+
+
+def normalized(settings):
+    """ batches of more than 10 messages need a batching window of at least a second """
+    settings = dict(settings)
+    if settings['batch_size'] > 10:
+        settings['batching_window'] = max(1, settings['batching_window'])
+    return settings
+
+
+def mapping_args(settings, current=None):
+    """ event source mapping arguments, ScalingConfig (botocore 1.29.50 or later) is only sent to set a concurrency
+        limit, or as an empty value to remove the limit of the current mapping """
+    args = {'BatchSize': settings['batch_size'], 'MaximumBatchingWindowInSeconds': settings['batching_window']}
+    if settings['max_concurrency'] is not None:
+        args['ScalingConfig'] = {'MaximumConcurrency': settings['max_concurrency']}
+    elif current is not None and current.get('ScalingConfig', {}).get('MaximumConcurrency') is not None:
+        args['ScalingConfig'] = {}
+    return args
+
+
+def grid(config, base):
+    """ the settings to measure, base supplies the timeout and visibility timeout used while measuring """
+    for memory_size, batch_size, concurrency in itertools.product(
+            config['memory_sizes'], config['batch_sizes'], config['concurrencies']):
+        yield normalized(dict(base, memory_size=memory_size, batch_size=batch_size,
+                              batching_window=config['batching_window'], max_concurrency=concurrency))
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Measurement:
+    """One setting run over the sample: invocations are (records, seconds) without cold start init"""
+
+    def __init__(self, settings, records, invocations, wall_seconds, cold_starts=0):
+        self.settings = settings
+        self.records = records
+        self.invocations = invocations
+        self.wall_seconds = wall_seconds
+        self.cold_starts = cold_starts
+
+    @property
+    def completed(self):
+        return sum(n for n, _ in self.invocations)
+
+    @property
+    def complete(self):
+        return self.completed >= self.records
+
+    def throughput(self):
+        return self.completed / self.wall_seconds if self.wall_seconds > 0 else 0
+
+    def record_seconds(self):
+        """ per-record seconds of every record, the duration of its invocation shared by its records """
+        return [s / n for n, s in self.invocations for _ in range(n)]
+
+    def cost_per_record(self, config):
+        """ billed in 1 ms steps, plus the request price of every invocation """
+        gb = self.settings['memory_size'] / 1024.0
+        cost = sum(math.ceil(s * 1000) / 1000 * gb * config['gb_second_price'] + config['request_price']
+                   for _, s in self.invocations)
+        return cost / self.completed if self.completed > 0 else float('inf')
+
+    def summary(self, config):
+        record_seconds = self.record_seconds()
+        return {
+            'settings': self.settings,
+            'records': self.records,
+            'completed': self.completed,
+            'invocations': len(self.invocations),
+            'cold_starts': self.cold_starts,
+            'wall_seconds': self.wall_seconds,
+            'throughput': self.throughput(),
+            'record_seconds_p50': quantile(record_seconds, 0.5) if record_seconds else None,
+            'record_seconds_p95': quantile(record_seconds, 0.95) if record_seconds else None,
+            'max_invocation_seconds': max((s for _, s in self.invocations), default=None),
+            'cost_per_million_records': self.cost_per_record(config) * 1e6
+        }
+
+
+def choose(measurements, config):
+    """ the measurement with the lowest cost per record among the complete ones that meet min_throughput and
+        max_record_seconds (a bound none of them meets is dropped) and reach throughput_share of the best
+        throughput of those, None when none is complete """
+    candidates = [m for m in measurements if m.complete]
+    if config['max_record_seconds'] is not None:
+        within = [m for m in candidates if quantile(m.record_seconds(), 0.95) <= config['max_record_seconds']]
+        candidates = within or candidates
+    if config['min_throughput'] is not None:
+        fast = [m for m in candidates if m.throughput() >= config['min_throughput']]
+        # none is fast enough, the fastest is as close as it gets
+        candidates = fast or sorted(candidates, key=Measurement.throughput)[-1:]
+    if len(candidates) == 0:
+        return None
+    best_throughput = max(m.throughput() for m in candidates)
+    candidates = [m for m in candidates if m.throughput() >= config['throughput_share'] * best_throughput]
+    return min(candidates, key=lambda m: (m.cost_per_record(config), -m.throughput()))
+
+
+def picked_settings(measurement):
+    """ the measured setting, with a timeout fitted to its slowest invocation and the queue's visibility timeout """
+    settings = dict(measurement.settings)
+    slowest = max(s for _, s in measurement.invocations)
+    settings['timeout'] = min(MAX_TIMEOUT, max(settings['timeout'], int(math.ceil(TIMEOUT_MARGIN * slowest))))
+    settings['visibility_timeout'] = VISIBILITY_TIMEOUT_FACTOR * settings['timeout']
+    return settings
+
+
+class Simulation:
+    """Latency model of a Lambda function processing SQS batches:
+       record_seconds: model time per record with one full vCPU, cpu_share: part of it that scales with the CPU
+       share, invocation_seconds: DynamoDB fetch / write / signal overhead per invocation, io_seconds: the same
+       per record, write_capacity: records/sec the tables take before throttling stretches the invocations,
+       memory_needed: MB below which the model runs out of memory, cold_start_seconds and jitter of the durations"""
+
+    def __init__(self, record_seconds=0.05, cpu_share=0.8, invocation_seconds=0.05, io_seconds=0.002,
+                 write_capacity=1000, memory_needed=512, cold_start_seconds=1.5, jitter=0.2, seed=0):
+        self.record_seconds = record_seconds
+        self.cpu_share = cpu_share
+        self.invocation_seconds = invocation_seconds
+        self.io_seconds = io_seconds
+        self.write_capacity = write_capacity
+        self.memory_needed = memory_needed
+        self.cold_start_seconds = cold_start_seconds
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def measure(self, settings, records, concurrency_limit=1000):
+        if settings['memory_size'] < self.memory_needed:
+            # every invocation fails, the records are never completed
+            return Measurement(settings, records, [], 0.0)
+        cpu = self.record_seconds * self.cpu_share * max(1.0, FULL_VCPU_MEMORY / settings['memory_size'])
+        per_record = cpu + self.record_seconds * (1 - self.cpu_share) + self.io_seconds
+        batch_size = settings['batch_size']
+        concurrency = min(settings['max_concurrency'] or concurrency_limit, int(math.ceil(records / batch_size)))
+        # with more records/sec than the tables take, throttled writes are retried and stretch every invocation
+        demand = concurrency * batch_size / (self.invocation_seconds + batch_size * per_record)
+        stretch = max(1.0, demand / self.write_capacity)
+
+        invocations = []
+        wall_seconds = self.cold_start_seconds
+        for wave in range(0, records, concurrency * batch_size):
+            sizes = [min(batch_size, records - x) for x in range(wave, min(records, wave + concurrency * batch_size),
+                                                                  batch_size)]
+            durations = [(self.invocation_seconds + n * per_record) * stretch * self.random.lognormvariate(0, self.jitter)
+                         for n in sizes]
+            invocations.extend(zip(sizes, durations))
+            wall_seconds += max(durations)
+        return Measurement(settings, records, invocations, wall_seconds, cold_starts=concurrency)
+
+
+class Calibration:
+    """Runs the grid for every exec type of a task and applies the picked settings through deploy.configure_lambda,
+       send(data_ids, queue_url) triggers the sample, as process_demo's trigger stage does"""
+
+    def __init__(self, deploy, config, sample_ids, send=None, simulate=False):
+        self.deploy = deploy
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.sample_ids = sample_ids
+        self.send = send
+        self.simulate = simulate
+        self.task_id = deploy.task_config['task_id']
+        self.cache_keys = load_cache_keys(deploy.task_workspace)
+        self.deployed = {}
+        self.completion_queue_url = None
+        # {exec_type: [Measurement]}
+        self.measurements = {}
+
+    def run(self, exec_types):
+        if not self.simulate:
+            self.load_deployed()
+        results = {}
+        for exec_type in exec_types:
+            base = self.deploy.lambda_settings(exec_type)
+            self.measurements[exec_type] = []
+            for settings in grid(self.config, base):
+                measurement = self.measure(exec_type, settings)
+                self.measurements[exec_type].append(measurement)
+                print("%s: %s" % (exec_type, self.describe(measurement)))
+            best = choose(self.measurements[exec_type], self.config)
+            if best is None:
+                raise RuntimeError('No setting completed the sample of %s' % exec_type)
+            results[exec_type] = {'settings': picked_settings(best),
+                                  'measurements': [m.summary(self.config) for m in self.measurements[exec_type]]}
+            self.print_report(exec_type, best)
+        self.save(results)
+        if not self.simulate:
+            for exec_type, result in results.items():
+                self.apply(exec_type, result['settings'])
+        return results
+
+    def load_deployed(self):
+        """ function name, event source mapping and work queue of every exec type from deployed_list.json """
+        from workflow.deploy import DeployItem
+        with open(os.path.join(self.deploy.task_workspace, 'deployed_list.json'), 'r') as f:
+            deployed = json.load(f)
+        queues = [v for k, v in deployed if k == DeployItem.SQS_QUEUE]
+        mappings = [v for k, v in deployed if k == DeployItem.LAMBDA_SQS_MAPPING]
+        self.completion_queue_url = [qu for qu in queues if qu.find('_completion') >= 0][0]
+        conn = self.deploy.client('lambda')
+        for uuid in mappings:
+            function_name = conn.get_event_source_mapping(UUID=uuid)['FunctionArn'].split(':')[-1]
+            exec_type = function_name[len(self.task_id) + 1:]
+            queue_url = [qu for qu in queues if qu.endswith('/' + function_name)][0]
+            self.deployed[exec_type] = (function_name, uuid, queue_url)
+
+    def measure(self, exec_type, settings):
+        if self.simulate:
+            return Simulation(**self.config['simulation']).measure(settings, len(self.sample_ids))
+        function_name, mapping_uuid, queue_url = self.deployed[exec_type]
+        self.deploy.configure_lambda(function_name, mapping_uuid, settings)
+        start = time.time()
+        self.send(self.sample_ids, queue_url)
+        measurement = self.collect(exec_type, settings, start)
+        if not measurement.complete:
+            print("%d / %d records of %s completed in %d seconds, purging the work queue..."
+                  % (measurement.completed, measurement.records, exec_type, self.config['sample_timeout']))
+            self.deploy.client('sqs').purge_queue(QueueUrl=queue_url)
+            time.sleep(PURGE_SECONDS)
+        return measurement
+
+    def collect(self, exec_type, settings, start):
+        """ read the sample's completion messages, grouping their timings by invocation """
+        sqs = self.deploy.client('sqs')
+        prefix = result_id_prefix(self.task_id, exec_type, self.cache_keys.get(exec_type))
+        expected = set(prefix + i for i in self.sample_ids)
+        done = set()
+        # {invocation: [records, seconds]}
+        invocations = {}
+        cold_starts = set()
+        last = start
+        while len(done) < len(expected) and time.time() - start < self.config['sample_timeout']:
+            messages = sqs.receive_message(QueueUrl=self.completion_queue_url, MaxNumberOfMessages=10,
+                                           WaitTimeSeconds=1, AttributeNames=['SentTimestamp'],
+                                           MessageAttributeNames=['timings']).get('Messages', [])
+            for m in messages:
+                result_ids = [r for r in Reducer.result_ids(m['Body']) if r in expected and r not in done]
+                timings = m.get('MessageAttributes', {}).get('timings')
+                if len(result_ids) == 0 or timings is None:
+                    continue
+                timings = json.loads(timings['StringValue'])
+                done.update(result_ids)
+                last = max(last, int(m['Attributes']['SentTimestamp']) / 1000.0)
+                # fetch and write are shared by the messages of an invocation, run is per message
+                invocation = invocations.setdefault(timings.get('invocation', m['MessageId']),
+                                                    [0, timings['fetch'] + timings['write']])
+                invocation[0] += len(result_ids)
+                invocation[1] += timings['run']
+                if timings.get('cold_start'):
+                    cold_starts.add(timings.get('invocation', m['MessageId']))
+            for x in range(0, len(messages), 10):
+                sqs.delete_message_batch(QueueUrl=self.completion_queue_url, Entries=[
+                    {'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages[x:x + 10])])
+            print("%d / %d records completed" % (len(done), len(expected)), end='\r')
+        print("")
+        return Measurement(settings, len(expected), [tuple(v) for v in invocations.values()], last - start,
+                           len(cold_starts))
+
+    def apply(self, exec_type, settings):
+        function_name, mapping_uuid, queue_url = self.deployed[exec_type]
+        self.deploy.configure_lambda(function_name, mapping_uuid, settings)
+        print('Setting visibility timeout of SQS queue %s to %d seconds...' % (queue_url, settings['visibility_timeout']))
+        self.deploy.client('sqs').set_queue_attributes(
+            QueueUrl=queue_url, Attributes={'VisibilityTimeout': str(settings['visibility_timeout'])})
+
+    def save(self, results):
+        path = os.path.join(self.deploy.task_workspace, SIMULATED_FILE_NAME if self.simulate else CALIBRATION_FILE_NAME)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Calibration saved to %s" % path)
+
+    def describe(self, measurement):
+        s = measurement.settings
+        if not measurement.complete:
+            return "%d MB, batch %d, concurrency %s: %d / %d records completed" \
+                   % (s['memory_size'], s['batch_size'], s['max_concurrency'] or '-', measurement.completed,
+                      measurement.records)
+        return "%d MB, batch %d, concurrency %s: %.1f records/sec, $%.4f per million records" \
+               % (s['memory_size'], s['batch_size'], s['max_concurrency'] or '-', measurement.throughput(),
+                  measurement.cost_per_record(self.config) * 1e6)
+
+    def print_report(self, exec_type, best):
+        print("Calibration of %s%s:" % (exec_type, ' (simulated)' if self.simulate else ''))
+        print("{0:>8} {1:>6} {2:>12} {3:>12} {4:>12} {5:>12} {6:>14}".format(
+            "memory", "batch", "concurrency", "records/sec", "p50 sec", "p95 sec", "$ per million"))
+        for m in self.measurements[exec_type]:
+            s = m.settings
+            if not m.complete:
+                print("{0:>8} {1:>6} {2:>12} {3:>12}".format(s['memory_size'], s['batch_size'],
+                                                               s['max_concurrency'] or '-', 'incomplete'))
+                continue
+            record_seconds = m.record_seconds()
+            print("{0:>8} {1:>6} {2:>12} {3:>12.1f} {4:>12.4f} {5:>12.4f} {6:>14.4f}{7}".format(
+                s['memory_size'], s['batch_size'], s['max_concurrency'] or '-', m.throughput(),
+                quantile(record_seconds, 0.5), quantile(record_seconds, 0.95), m.cost_per_record(self.config) * 1e6,
+                ' <' if m is best else ''))
+        settings = picked_settings(best)
+        print("Picked %d MB, batch %d (%d seconds window), concurrency %s, timeout %d seconds"
+              % (settings['memory_size'], settings['batch_size'], settings['batching_window'],
+                 settings['max_concurrency'] or 'unreserved', settings['timeout']))
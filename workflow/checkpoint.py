@@ -0,0 +1,55 @@
+"""Append-only checkpoints of a reduce run.
+
+Every checkpoint is a new segment file holding, per test variant, the data ids finished since the previous one and
+a Comparator with just their diffs. Segments are written to a temporary file and renamed, so a crash leaves either
+a whole segment or none, and the finished ids always match the comparator state. Loading merges all segments.
+"""
+import os
+import pickle
+import shutil
+
+SEGMENT_PREFIX = 'segment_'
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.sequence = len(self.segments())
+
+    def segments(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(f for f in os.listdir(self.path) if f.startswith(SEGMENT_PREFIX) and not f.endswith('.tmp'))
+
+    def reset(self):
+        """ start over, for a reduce that does not resume """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.sequence = 0
+
+    def append(self, comparators, finished_ids):
+        """ comparators: {variant: Comparator}, finished_ids: {variant: data ids} """
+        if sum(len(ids) for ids in finished_ids.values()) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        segment_path = os.path.join(self.path, '%s%08d' % (SEGMENT_PREFIX, self.sequence))
+        tmp_path = segment_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'ids': {v: list(ids) for v, ids in finished_ids.items()}, 'comparators': comparators}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, segment_path)
+        self.sequence += 1
+
+    def load(self, comparators):
+        """ merge the saved comparator states into {variant: Comparator}, returns {variant: finished data ids} """
+        finished = {}
+        for name in self.segments():
+            with open(os.path.join(self.path, name), 'rb') as f:
+                segment = pickle.load(f)
+            for v, comparator in segment['comparators'].items():
+                if v in comparators:
+                    comparators[v].merge(comparator)
+                    finished.setdefault(v, set()).update(segment['ids'][v])
+        return finished
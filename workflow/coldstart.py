@@ -0,0 +1,85 @@
+"""Cold-start helpers for the generated Lambda handlers.
+
+Every step runs the task's own interpreter, so bytecode and bundles match the Lambda runtime the libraries
+were installed for.
+"""
+import os
+import re
+import json
+import subprocess
+
+PROFILE_FILE_NAME = 'import_profile.json'
+BUNDLE_FILE_NAME = 'hot_modules.zip'
+COMPILED_MARKER = '.compiled'
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def precompile(python_command, lib_location):
+    """ write __pycache__ bytecode for the library directory once, so cold starts do not compile over EFS """
+    marker = os.path.join(lib_location, COMPILED_MARKER)
+    if os.path.exists(marker):
+        return False
+    subprocess.run([python_command, '-m', 'compileall', '-q', '-j', '0', lib_location], check=True)
+    open(marker, 'w').close()
+    return True
+
+
+def import_profile(python_command, package_location, lib_location):
+    """ -X importtime profile of importing the model with the handler's sys.path,
+        returns [{module, self_us, cumulative_us, depth}] in import order """
+    code = 'import sys; sys.path[0:0] = [%r, %r]; import model' % (package_location, lib_location)
+    result = subprocess.run([python_command, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+    profile = []
+    for line in result.stderr.splitlines():
+        m = IMPORT_TIME_LINE.match(line)
+        if m:
+            profile.append({'module': m.group(4), 'self_us': int(m.group(1)), 'cumulative_us': int(m.group(2)),
+                            'depth': (len(m.group(3)) - 1) // 2})
+    return profile
+
+
+def save_profile(profile, path):
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+
+
+def hottest_packages(profile, lib_location, n=10):
+    """ top-level packages from the library directory with the largest cumulative import time
+        (the largest cumulative time of any of their modules, as nested imports are already included) """
+    totals = {}
+    for p in profile:
+        top = p['module'].split('.')[0]
+        if os.path.isdir(os.path.join(lib_location, top)) or os.path.exists(os.path.join(lib_location, top + '.py')):
+            totals[top] = max(totals.get(top, 0), p['cumulative_us'])
+    return sorted(totals, key=totals.get, reverse=True)[:n]
+
+
+def bundleable(lib_location, package):
+    """ only pure-Python packages without data files can be imported from a zip """
+    path = os.path.join(lib_location, package)
+    if os.path.isfile(path + '.py'):
+        return True
+    if not os.path.isfile(os.path.join(path, '__init__.py')):
+        return False
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        if any(not f.endswith('.py') for f in files):
+            return False
+    return True
+
+
+def build_bundle(python_command, lib_location, packages, bundle_path):
+    """ zip-import bundle of precompiled packages (zipfile.PyZipFile), returns the packages it holds """
+    packages = [p for p in packages if bundleable(lib_location, p)]
+    if len(packages) == 0:
+        return packages
+    paths = [os.path.join(lib_location, p + '.py') if os.path.isfile(os.path.join(lib_location, p + '.py'))
+             else os.path.join(lib_location, p) for p in packages]
+    code = 'import sys, zipfile\n' \
+           'z = zipfile.PyZipFile(sys.argv[1], "w", optimize=0)\n' \
+           'for p in sys.argv[2:]:\n' \
+           '    z.writepy(p)\n' \
+           'z.close()\n'
+    subprocess.run([python_command, '-c', code, bundle_path] + paths, check=True)
+    return packages
@@ -0,0 +1,63 @@
+"""Columnar historical dataset: one float64 .npy file per field, the data ids in row order and a manifest.
+
+Readers memory-map the column files, so slicing a range of rows does not copy the columns.
+The module only depends on NumPy and is copied next to the generated Lambda handler when the
+task reads its data from EFS.
+"""
+import os
+import json
+import shutil
+import numpy as np
+
+MANIFEST_FILE_NAME = 'manifest.json'
+IDS_FILE_NAME = 'ids.npy'
+DATASETS_DIR_NAME = 'datasets'
+
+
+def dataset_path(mount_path, task_id):
+    """ location of a task's dataset under an EFS mount point (or the local task workspace) """
+    return os.path.join(mount_path, DATASETS_DIR_NAME, task_id)
+
+
+def write_dataset(path, ids, columns):
+    """ write ids and {name: values} columns to path, replacing an existing dataset atomically """
+    tmp_path = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, IDS_FILE_NAME), np.asarray(ids, dtype=str))
+    for name, values in columns.items():
+        values = np.ascontiguousarray(values, dtype='<f8')
+        if len(values) != len(ids):
+            raise ValueError('Column %s has %d rows, expected %d' % (name, len(values), len(ids)))
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+    with open(os.path.join(tmp_path, MANIFEST_FILE_NAME), 'w') as f:
+        json.dump({'rows': len(ids), 'columns': list(columns)}, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class Dataset:
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST_FILE_NAME)) as f:
+            manifest = json.load(f)
+        self.rows_count = manifest['rows']
+        self.ids = np.load(os.path.join(path, IDS_FILE_NAME), mmap_mode='r')
+        self.columns = {c: np.load(os.path.join(path, c + '.npy'), mmap_mode='r') for c in manifest['columns']}
+        self._index = None
+
+    def __len__(self):
+        return self.rows_count
+
+    def row_of(self, data_id):
+        """ id -> row index, built on first use """
+        if self._index is None:
+            self._index = {data_id: i for i, data_id in enumerate(self.ids.tolist())}
+        return self._index[data_id]
+
+    def rows(self, start, end):
+        """ data ids and data items ({column: value}) of rows [start, end) """
+        ids = self.ids[start:end].tolist()
+        values = {c: v[start:end].tolist() for c, v in self.columns.items()}
+        return ids, [{c: values[c][i] for c in values} for i in range(len(ids))]
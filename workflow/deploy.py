@@ -6,50 +6,136 @@ import shutil
 import jinja2
 import boto3
 import json
+import time
+import base64
+import hashlib
+import zipfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from workflow.dataset import dataset_path
+from workflow.cache import CACHE_KEYS_FILE_NAME, compute_cache_key, result_id_prefix
+from workflow.libstore import LibraryStore
+from workflow import coldstart, calibrate
+from workflow.variants import exec_types, section
 
 
 class Deploy:
     DEPLOY_PACKAGE_FILE_NAME = 'deployment-package.zip'
 
     def __init__(self, deploy_config, task_config):
+        # Lambda and work queue settings, per exec type they are overridden by a calibration run (see lambda_settings)
+        self.lambda_memory_size = 2048
+        self.lambda_timeout = 30
+        self.lambda_batch_size = 10
+        self.lambda_batching_window = 0
+        self.lambda_max_concurrency = None
+        self.sqs_visibility_timeout = 30
         for k, v in deploy_config.items():
             setattr(self, k, v)
         self.task_workspace = os.path.join(self.workspace_path, task_config['task_id'])
         self.task_config = task_config
         self.deployed_list = []
         self.context = {}
+        # {exec_type: key} of packages whose results are cached across tasks (see workflow.cache)
+        self.cache_keys = {}
+        # {exec_type: key} of the shared library directories on EFS (see workflow.libstore)
+        self.library_keys = {}
+        self.completion_queue_url = None
+        self.completion_queue = None
+        # seconds spent per '<exec_type>.<step>'
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.repo_locks = {}
 
     def run(self):
+        """ the completion queue and the benchmark and test sub-pipelines are deployed concurrently """
+        start = time.time()
         try:
             os.makedirs(self.task_workspace, exist_ok=True)
-            # create sqs queue for completion signal
-            print('Creating SQS completion queue...')
-            self.completion_queue_url, _ = self.create_sqs(self.task_config['task_id'] + '_completion')
-            print('Deploying benchmark processes...')
-            self.sub_pipeline('benchmark')
-            print('Deploying test processes...')
-            self.sub_pipeline('test')
+            with ThreadPoolExecutor(max_workers=1 + len(exec_types(self.task_config))) as executor:
+                # create sqs queue for completion signal
+                print('Creating SQS completion queue...')
+                self.completion_queue = executor.submit(self.step, 'completion', 'create_sqs', self.create_sqs,
+                                                        self.task_config['task_id'] + '_completion')
+                print('Deploying benchmark and test processes...')
+                futures = [executor.submit(self.sub_pipeline, exec_type) for exec_type in exec_types(self.task_config)]
+                self.completion_queue_url, _ = self.completion_queue.result()
+                for f in futures:
+                    f.result()
         finally:
             list_path = os.path.join(self.task_workspace, 'deployed_list.json')
             with open(list_path, 'w') as f:
                 json.dump(self.deployed_list, f, indent=2)
+            with open(os.path.join(self.task_workspace, CACHE_KEYS_FILE_NAME), 'w') as f:
+                json.dump(self.cache_keys, f, indent=2)
+            self.print_timings(time.time() - start)
 
     def sub_pipeline(self, exec_type='benchmark'):
         exec_location = os.path.join(self.task_workspace, exec_type)
         os.makedirs(exec_location, exist_ok=True)
+        package_location = os.path.join(exec_location, 'package')
+        requirements = os.path.join(package_location, 'requirements.txt')
+        python_command = section(self.task_config, exec_type)['python']
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # the work queue does not depend on the package
+            settings = self.lambda_settings(exec_type)
+            queue = executor.submit(self.step, exec_type, 'create_sqs', self.create_sqs,
+                                    self.task_config['task_id'] + '_' + exec_type, False, settings['visibility_timeout'])
+            self.step(exec_type, 'fetch_source', self.fetch_source, exec_type, package_location)
+            self.step(exec_type, 'fetch_files', self.fetch_files, exec_type, package_location)
+            self.library_keys[exec_type] = self.step(exec_type, 'library_key', LibraryStore.key, python_command,
+                                                     requirements,
+                                                     os.path.join(exec_location, LibraryStore.RESOLVED_FILE_NAME))
+            self.step(exec_type, 'record_cache_key', self.record_cache_key, exec_type, package_location)
+            self.wait_for_completion_queue()
+            self.step(exec_type, 'generate_handler', self.generate_handler, exec_type, package_location)
+
+            # libraries are installed while the package is built and the function deployed
+            libraries = executor.submit(self.step, exec_type, 'deploy_libraries', self.deploy_libraries,
+                                        python_command, requirements, exec_type)
+            if self.task_config.get('cold_start_optimization', False) or self.task_config.get('cold_start_bundle', False):
+                # the bundle goes into the package, so the libraries have to be there first
+                libraries.result()
+                self.step(exec_type, 'optimize_cold_start', self.optimize_cold_start, exec_type, python_command, exec_location)
+            self.step(exec_type, 'package_source', self.package_source, exec_location)
+            sqs_url, sqs_arn = queue.result()
+            function_name = self.task_config['task_id'] + '_' + exec_type
+            self.step(exec_type, 'deploy_lambda', self.deploy_lambda, function_name, sqs_arn,
+                      os.path.join(exec_location, Deploy.DEPLOY_PACKAGE_FILE_NAME), settings)
+            libraries.result()
+
+    def wait_for_completion_queue(self):
+        if self.completion_queue_url is None and self.completion_queue is not None:
+            self.completion_queue_url, _ = self.completion_queue.result()
+
+    def step(self, exec_type, name, func, *args):
+        with self.timed(exec_type + '.' + name):
+            return func(*args)
 
-        self.fetch_source(exec_type, os.path.join(exec_location, 'package'))
-        self.fetch_files(exec_type, os.path.join(exec_location, 'package'))
-        self.generate_handler(exec_type, os.path.join(exec_location, 'package'))
-        self.package_source(exec_location)
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.timings[name] = time.time() - start
 
-        exec_efs_lib_location = os.path.join(self.ec2_efs_mount_path, self.task_config['task_id'], exec_type)
-        os.makedirs(exec_efs_lib_location, exist_ok=True)
-        self.deploy_libraries(self.task_config[exec_type]['python'], exec_efs_lib_location)
-        sqs_url, sqs_arn = self.create_sqs(self.task_config['task_id'] + '_' + exec_type)
+    def print_timings(self, total):
+        print("Deploy time: %.2f seconds" % total)
+        print("{0:>40} {1:>10}".format("step", "seconds"))
+        for k, v in sorted(self.timings.items()):
+            print("{0:>40} {1:>10.2f}".format(k, v))
+        with open(os.path.join(self.task_workspace, 'deploy_timings.json'), 'w') as f:
+            json.dump(dict(self.timings, total=total), f, indent=2)
 
-        function_name = self.task_config['task_id'] + '_' + exec_type
-        self.deploy_lambda(function_name, sqs_arn, os.path.join(exec_location, Deploy.DEPLOY_PACKAGE_FILE_NAME))
+    def client(self, service):
+        """ boto3 client creation is not thread-safe, clients themselves are """
+        with self.lock:
+            return boto3.client(service)
 
     def clean_up(self):
         list_path = os.path.join(self.task_workspace, 'deployed_list.json')
@@ -59,69 +145,136 @@ class Deploy:
                 self.deployed_list = json.load(f)
         try:
             while len(self.deployed_list) > 0:
-                t = self.deployed_list.pop(0)
-                if t[0] == DeployItem.LAMBDA:
-                    print('Deleting Lambda function: %s' % t[1])
-                    conn = boto3.client('lambda')
-                    conn.delete_function(FunctionName=t[1])
-                elif t[0] == DeployItem.SQS_QUEUE:
-                    print('Deleting SQS queue: %s' % t[1])
-                    conn = boto3.client('sqs')
-                    conn.delete_queue(QueueUrl=t[1])
-                elif t[0] == DeployItem.EFS_MOUNT:
-                    continue
-                elif t[0] == DeployItem.DYNAMODB:
-                    continue
-                elif t[0] == DeployItem.LOCAL_FILES:
-                    print('Deleting local file: %s' % t[1])
-                    if os.path.exists(t[1]):
-                        shutil.rmtree(t[1])
-                elif t[0] == DeployItem.LAMBDA_SQS_MAPPING:
-                    print('Deleting Lambda-SQS mapping: %s' % t[1])
-                    conn = boto3.client('lambda')
-                    conn.delete_event_source_mapping(UUID=t[1])
+                self.clean_up_item(self.deployed_list.pop(0))
         finally:
             with open(list_path, 'w') as f:
                 json.dump(self.deployed_list, f, indent=2)
 
+    def clean_up_item(self, t):
+        if t[0] == DeployItem.LAMBDA:
+            print('Deleting Lambda function: %s' % t[1])
+            conn = self.client('lambda')
+            conn.delete_function(FunctionName=t[1])
+        elif t[0] == DeployItem.SQS_QUEUE:
+            print('Deleting SQS queue: %s' % t[1])
+            conn = self.client('sqs')
+            conn.delete_queue(QueueUrl=t[1])
+        elif t[0] == DeployItem.EFS_MOUNT:
+            print('Releasing EFS libraries: %s' % t[1])
+            LibraryStore(self.ec2_efs_mount_path).release(t[1])
+        elif t[0] == DeployItem.DYNAMODB:
+            return
+        elif t[0] == DeployItem.LOCAL_FILES:
+            print('Deleting local file: %s' % t[1])
+            if os.path.exists(t[1]):
+                shutil.rmtree(t[1])
+        elif t[0] == DeployItem.LAMBDA_SQS_MAPPING:
+            print('Deleting Lambda-SQS mapping: %s' % t[1])
+            conn = self.client('lambda')
+            conn.delete_event_source_mapping(UUID=t[1])
+
+    def stop_work(self):
+        """ stop the processing of a task decided early: the event source mappings are disabled and the work
+            queues purged, the completion queue and everything else are left for the reducer and clean_up """
+        list_path = os.path.join(self.task_workspace, 'deployed_list.json')
+        if len(self.deployed_list) == 0:
+            with open(list_path, 'r') as f:
+                self.deployed_list = json.load(f)
+        # mappings first, so that no poller picks up work while the queues are purged
+        for t in sorted(self.deployed_list, key=lambda t: t[0] != DeployItem.LAMBDA_SQS_MAPPING):
+            self.stop_item(t)
+
+    def stop_item(self, t):
+        if t[0] == DeployItem.LAMBDA_SQS_MAPPING:
+            print('Disabling Lambda-SQS mapping: %s' % t[1])
+            self.client('lambda').update_event_source_mapping(UUID=t[1], Enabled=False)
+        elif t[0] == DeployItem.SQS_QUEUE and t[1].find('_completion') < 0:
+            print('Purging SQS queue: %s' % t[1])
+            self.client('sqs').purge_queue(QueueUrl=t[1])
+
     def register_deployed(self, object_type, identifier):
-        self.deployed_list.append((object_type, identifier))
+        with self.lock:
+            self.deployed_list.append((object_type, identifier))
 
     def template_dict(self, exec_type):
         if self.completion_queue_url is None:
             raise RuntimeError("Completion queue has to be created first")
         return {
-            'lib_location': os.path.join(self.lambda_efs_mount_path, self.task_config['task_id'], exec_type),
+            'lib_location': LibraryStore(self.lambda_efs_mount_path).path(self.library_keys[exec_type]),
             'completion_queue': self.completion_queue_url,
             'exec_type': exec_type,
-            'task_id': self.task_config['task_id']
+            'task_id': self.task_config['task_id'],
+            'result_id_prefix': result_id_prefix(self.task_config['task_id'], exec_type, self.cache_keys.get(exec_type)),
+            'result_format': self.task_config.get('result_format', 'decimal'),
+            'result_compression': self.task_config.get('result_compression', True),
+            # columnar dataset on EFS that work messages can refer to by row range (see workflow.dataset)
+            'dataset_location': dataset_path(self.lambda_efs_mount_path, self.task_config['task_id'])
+            if self.task_config.get('dataset') == 'efs' else '',
+            'cold_start_bundle': coldstart.BUNDLE_FILE_NAME if self.task_config.get('cold_start_bundle', False) else ''
         }
 
     def fetch_source(self, exec_type, save_path):
+        """ shallow checkout of the branch from a bare clone cached in the workspace,
+            an existing checkout of the same repo is updated in place """
         print('Pulling source code from git repo...')
-        source_code_repo = self.task_config[exec_type]['git']
-        branch = self.task_config[exec_type]['branch']
-        if os.path.exists(save_path):
-            shutil.rmtree(save_path)
-        os.makedirs(save_path, exist_ok=True)
-        git.Repo.clone_from(
-            source_code_repo,
-            save_path,
-            branch=branch
-        )
+        source_code_repo = section(self.task_config, exec_type)['git']
+        branch = section(self.task_config, exec_type)['branch']
+        cache_path = os.path.join(self.workspace_path, '.git_cache', hashlib.sha1(source_code_repo.encode()).hexdigest()[:16])
+        with self.repo_lock(cache_path):
+            if os.path.exists(cache_path):
+                cache = git.Repo(cache_path)
+            else:
+                cache = git.Repo.init(cache_path, bare=True)
+                cache.create_remote('origin', source_code_repo)
+            cache.git.fetch('origin', '+refs/heads/%s:refs/heads/%s' % (branch, branch), depth=1)
+
+            if os.path.exists(os.path.join(save_path, '.git')):
+                repo = git.Repo(save_path)
+                repo.git.fetch('file://' + cache_path, branch, depth=1)
+                repo.git.reset('--hard', 'FETCH_HEAD')
+                repo.git.clean('-fdx')
+            else:
+                if os.path.exists(save_path):
+                    shutil.rmtree(save_path)
+                git.Repo.clone_from('file://' + cache_path, save_path, branch=branch, depth=1)
         self.register_deployed(DeployItem.LOCAL_FILES, save_path)
 
+    def repo_lock(self, path):
+        """ one lock per cached repo, benchmark and test often come from the same one """
+        with self.lock:
+            return self.repo_locks.setdefault(path, threading.Lock())
+
     def fetch_files(self, exec_type, save_path):
         print('Fetching support files...')
         os.makedirs(save_path, exist_ok=True)
-        urls_to_be_fetched = self.task_config[exec_type]['files']
-        for u in urls_to_be_fetched:
-            r = requests.get(u, allow_redirects=True)
-            file_name = u.rsplit('/', 1)[1]
-            with open(os.path.join(save_path, file_name), 'wb') as f:
-                f.write(r.content)
+        urls_to_be_fetched = section(self.task_config, exec_type)['files']
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(urls_to_be_fetched)))) as executor:
+            for f in [executor.submit(Deploy.download, u, save_path) for u in urls_to_be_fetched]:
+                f.result()
         self.register_deployed(DeployItem.LOCAL_FILES, save_path)
 
+    @staticmethod
+    def download(url, save_path):
+        """ stream a file to disk instead of holding it in memory """
+        file_name = url.rsplit('/', 1)[1]
+        tmp_path = os.path.join(save_path, file_name + '.download')
+        with requests.get(url, allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        os.replace(tmp_path, os.path.join(save_path, file_name))
+
+    def record_cache_key(self, exec_type, package_path):
+        """ benchmark results are cached by resolved commit, library key (interpreter version and resolved
+            requirements) and support files when 'benchmark_cache' is set in the task config """
+        if exec_type != 'benchmark' or not self.task_config.get('benchmark_cache', False):
+            return
+        commit = git.Repo(package_path).head.commit.hexsha
+        file_names = [u.rsplit('/', 1)[1] for u in self.task_config[exec_type]['files']]
+        self.cache_keys[exec_type] = compute_cache_key(commit, self.library_keys[exec_type], package_path, file_names)
+        print('Benchmark results are cached under %s' % self.cache_keys[exec_type])
+
     def generate_handler(self, exec_type, save_path):
         print('Generating lambda function handler...')
         cur_dir = os.path.dirname(os.path.realpath(__file__))
@@ -130,31 +283,99 @@ class Deploy:
             template = jinja2.Template(f.read())
         with open(os.path.join(save_path, 'lambda_function.py'), 'w') as f:
             f.write(template.render(template_dict))
+        if template_dict['result_format'] == 'binary':
+            shutil.copy(os.path.join(cur_dir, 'result_codec.py'), save_path)
+        if template_dict['dataset_location']:
+            shutil.copy(os.path.join(cur_dir, 'dataset.py'), save_path)
         self.register_deployed(DeployItem.LOCAL_FILES, save_path)
 
     def package_source(self, exec_location):
+        """ zip the package in-process, skipped when the source tree hash matches the existing package """
+        package_location = os.path.join(exec_location, 'package')
+        zip_path = os.path.join(exec_location, Deploy.DEPLOY_PACKAGE_FILE_NAME)
+        hash_path = zip_path + '.sha256'
+        files = []
+        for root, dirs, file_names in os.walk(package_location):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.git'))
+            files.extend(os.path.join(root, n) for n in sorted(file_names) if not n.startswith('.git'))
+        h = hashlib.sha256()
+        for path in files:
+            h.update(os.path.relpath(path, package_location).encode())
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        tree_hash = h.hexdigest()
+        if os.path.exists(zip_path) and os.path.exists(hash_path):
+            with open(hash_path, 'r') as f:
+                if f.read() == tree_hash:
+                    print('Deployment package is up to date')
+                    self.register_deployed(DeployItem.LOCAL_FILES, exec_location)
+                    return
+
         print('Creating deployment package...')
-        subprocess.run(['zip', '-r', '../%s' % Deploy.DEPLOY_PACKAGE_FILE_NAME, './', '-x', '*.git*'], cwd=os.path.join(exec_location, 'package'))
+        with zipfile.ZipFile(zip_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as z:
+            for path in files:
+                z.write(path, os.path.relpath(path, package_location))
+        os.replace(zip_path + '.tmp', zip_path)
+        with open(hash_path, 'w') as f:
+            f.write(tree_hash)
         self.register_deployed(DeployItem.LOCAL_FILES, exec_location)
 
-    def deploy_libraries(self, python_command, lib_location):
+    def optimize_cold_start(self, exec_type, python_command, exec_location):
+        """ precompile the shared libraries, record the model's import-time profile and, with 'cold_start_bundle',
+            zip the hottest pure-Python packages into the deployment package """
+        lib_location = LibraryStore(self.ec2_efs_mount_path).path(self.library_keys[exec_type])
+        package_location = os.path.join(exec_location, 'package')
+        if coldstart.precompile(python_command, lib_location):
+            print('Precompiled libraries: %s' % self.library_keys[exec_type])
+        profile = coldstart.import_profile(python_command, package_location, lib_location)
+        coldstart.save_profile(profile, os.path.join(exec_location, coldstart.PROFILE_FILE_NAME))
+        print('Slowest imports of the %s model:' % exec_type)
+        for p in sorted(profile, key=lambda p: p['cumulative_us'], reverse=True)[:5]:
+            print("{0:>40} {1:>10.3f}s".format(p['module'], p['cumulative_us'] / 1e6))
+        if self.task_config.get('cold_start_bundle', False):
+            hot = coldstart.hottest_packages(profile, lib_location, self.task_config.get('cold_start_bundle_size', 10))
+            bundled = coldstart.build_bundle(python_command, lib_location, hot,
+                                             os.path.join(package_location, coldstart.BUNDLE_FILE_NAME))
+            print('Bundled packages: %s' % ', '.join(bundled))
+
+    def deploy_libraries(self, python_command, requirements, exec_type):
         """ deploy libraries to EFS (this has to be executed on a Lambda matching EC2 instance,
-            otherwise compiled libraries will not be able to load) """
-        print('Deploying dependencies to EFS...')
-        os.makedirs(lib_location, exist_ok=True)
-        subprocess.run([python_command, '-m', 'pip', 'install', '-q', '-r', 'requirements.txt', '-t', lib_location])
-        self.register_deployed(DeployItem.EFS_MOUNT, lib_location)
+            otherwise compiled libraries will not be able to load). Libraries are installed once per
+            interpreter and requirements into the shared store and reused by later deployments. """
+        store = LibraryStore(self.ec2_efs_mount_path)
+        key = self.library_keys[exec_type]
+        ref_path = store.add_ref(key, self.task_config['task_id'] + '_' + exec_type)
+        self.register_deployed(DeployItem.EFS_MOUNT, ref_path)
+        # the versions the key was computed from are installed
+        resolved = os.path.join(self.task_workspace, exec_type, LibraryStore.RESOLVED_FILE_NAME)
+
+        def install(path):
+            # a package without requirements gets an empty directory
+            if not os.path.exists(requirements):
+                os.makedirs(path)
+                return
+            subprocess.run([python_command, '-m', 'pip', 'install', '-q', '-r', requirements, '-c', resolved, '-t', path],
+                           check=True)
+
+        if store.publish(key, install):
+            print('Deployed dependencies to EFS: %s' % key)
+        else:
+            print('Dependencies already on EFS: %s' % key)
 
-    def create_sqs(self, queue_name, fifo=False):
+    def create_sqs(self, queue_name, fifo=False, visibility_timeout=None):
         print('Creating SQS queue "%s"...' % queue_name)
-        conn = boto3.client('sqs')
-        get_response = conn.list_queues(QueueNamePrefix=queue_name)
-        if 'QueueUrls' not in get_response or len(get_response['QueueUrls']) == 0:
+        conn = self.client('sqs')
+        visibility_timeout = str(visibility_timeout or self.sqs_visibility_timeout)
+        if fifo:
+            queue_name += '.fifo'
+        # the prefix also matches longer names, e.g. <task>_test_v10 for <task>_test_v1
+        queue_urls = [qu for qu in conn.list_queues(QueueNamePrefix=queue_name).get('QueueUrls', [])
+                      if qu.endswith('/' + queue_name)]
+        if len(queue_urls) == 0:
             attr = {
-                'VisibilityTimeout': '30'
+                'VisibilityTimeout': visibility_timeout
             }
             if fifo:
-                queue_name += '.fifo'
                 attr['FifoQueue'] = 'true'
                 attr['ContentBasedDeduplication'] = 'true'
 
@@ -165,56 +386,145 @@ class Deploy:
             queue_url = create_response['QueueUrl']
         else:
             # if the queue already exists, purge it
-            if len(get_response['QueueUrls']) > 1:
-                raise RuntimeError('Multiple existing SQS queues matches search criteria: %s' % ','.join(get_response['QueueUrls']))
+            if len(queue_urls) > 1:
+                raise RuntimeError('Multiple existing SQS queues matches search criteria: %s' % ','.join(queue_urls))
             print("SQS queue %s exists, purging..." % queue_name)
-            conn.purge_queue(QueueUrl=get_response['QueueUrls'][0])
-            queue_url = get_response['QueueUrls'][0]
+            conn.purge_queue(QueueUrl=queue_urls[0])
+            queue_url = queue_urls[0]
+            conn.set_queue_attributes(QueueUrl=queue_url, Attributes={'VisibilityTimeout': visibility_timeout})
 
         attr_response = conn.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])
         self.register_deployed(DeployItem.SQS_QUEUE, queue_url)
         return queue_url, attr_response['Attributes']['QueueArn']
 
-    def deploy_lambda(self, function_name, sqs_queue_arn, zip_file_path):
+    def lambda_settings(self, exec_type):
+        """ memory, timeout, batching and concurrency of an exec type's function and the visibility timeout of its
+            work queue: the lambda_* / sqs_* values of deploy_config, or the settings picked by a calibration run """
+        settings = {
+            'memory_size': self.lambda_memory_size,
+            'timeout': self.lambda_timeout,
+            'batch_size': self.lambda_batch_size,
+            'batching_window': self.lambda_batching_window,
+            'max_concurrency': self.lambda_max_concurrency,
+            'visibility_timeout': self.sqs_visibility_timeout
+        }
+        settings.update(calibrate.load_settings(self.task_workspace).get(exec_type, {}))
+        return calibrate.normalized(settings)
+
+    def deploy_lambda(self, function_name, sqs_queue_arn, zip_file_path, settings):
+        """ creates the function and its SQS trigger, or updates the code and settings (see lambda_settings) of an
+            existing one """
         print('Deploying Lambda function "%s"...' % function_name)
         with open(zip_file_path, 'rb') as f:
             zip_file = f.read()
 
-        # create
-        conn = boto3.client('lambda')
-        response = conn.create_function(
-            FunctionName=function_name,
-            Runtime='python3.8',
-            Role=self.aws_role_lambda_arn,
-            Handler='lambda_function.lambda_handler',
-            Timeout=30,
-            MemorySize=2048,
-            Code={
-                'ZipFile': zip_file
-            },
-            FileSystemConfigs=[
-                {
-                    'Arn': self.efs_ap_arn,
-                    'LocalMountPath': self.lambda_efs_mount_path
+        conn = self.client('lambda')
+        try:
+            existing = conn.get_function(FunctionName=function_name)['Configuration']
+        except conn.exceptions.ResourceNotFoundException:
+            existing = None
+
+        if existing is not None:
+            # Lambda reports the base64 encoded SHA-256 of the deployed package
+            if existing['CodeSha256'] == base64.b64encode(hashlib.sha256(zip_file).digest()).decode():
+                print('Lambda function "%s" is up to date' % function_name)
+            else:
+                print('Updating code of Lambda function "%s"...' % function_name)
+                conn.update_function_code(FunctionName=function_name, ZipFile=zip_file)
+            self.register_deployed(DeployItem.LAMBDA, existing['FunctionArn'])
+            self.configure_function(conn, function_name, settings)
+        else:
+            # create
+            response = conn.create_function(
+                FunctionName=function_name,
+                Runtime='python3.8',
+                Role=self.aws_role_lambda_arn,
+                Handler='lambda_function.lambda_handler',
+                Timeout=settings['timeout'],
+                MemorySize=settings['memory_size'],
+                Code={
+                    'ZipFile': zip_file
                 },
-            ],
-            VpcConfig={
-                'SubnetIds': self.lambda_vpc_subnet_ids,
-                'SecurityGroupIds': [
-                    self.lambda_security_group_id,
-                ]
-            }
-        )
-        self.register_deployed(DeployItem.LAMBDA, response['FunctionArn'])
+                FileSystemConfigs=[
+                    {
+                        'Arn': self.efs_ap_arn,
+                        'LocalMountPath': self.lambda_efs_mount_path
+                    },
+                ],
+                VpcConfig={
+                    'SubnetIds': self.lambda_vpc_subnet_ids,
+                    'SecurityGroupIds': [
+                        self.lambda_security_group_id,
+                    ]
+                }
+            )
+            self.register_deployed(DeployItem.LAMBDA, response['FunctionArn'])
 
-        # set trigger
+        # set trigger, an existing mapping between the queue and the function is reused
+        mappings = conn.list_event_source_mappings(EventSourceArn=sqs_queue_arn, FunctionName=function_name)
+        if len(mappings['EventSourceMappings']) > 0:
+            self.register_deployed(DeployItem.LAMBDA_SQS_MAPPING, mappings['EventSourceMappings'][0]['UUID'])
+            self.configure_mapping(conn, mappings['EventSourceMappings'][0]['UUID'], settings)
+            return
         response = conn.create_event_source_mapping(
-            BatchSize=10,
             EventSourceArn=sqs_queue_arn,
             FunctionName=function_name,
+            # the handler returns batchItemFailures so only failed records are redelivered
+            FunctionResponseTypes=['ReportBatchItemFailures'],
+            **calibrate.mapping_args(settings)
         )
         self.register_deployed(DeployItem.LAMBDA_SQS_MAPPING, response['UUID'])
 
+    def configure_lambda(self, function_name, mapping_uuid, settings):
+        """ apply memory, timeout, batching and concurrency to a deployed function and its SQS trigger (which is
+            enabled again if it was stopped), returns once the changes are in effect """
+        conn = self.client('lambda')
+        self.configure_function(conn, function_name, settings)
+        self.configure_mapping(conn, mapping_uuid, settings)
+
+    @staticmethod
+    def configure_function(conn, function_name, settings):
+        config = conn.get_function_configuration(FunctionName=function_name)
+        if config['MemorySize'] == settings['memory_size'] and config['Timeout'] == settings['timeout']:
+            return
+        print('Setting Lambda function "%s" to %d MB, %d seconds timeout...'
+              % (function_name, settings['memory_size'], settings['timeout']))
+        # a code update still in progress would make the configuration update fail
+        conn.get_waiter('function_updated').wait(FunctionName=function_name)
+        conn.update_function_configuration(FunctionName=function_name, MemorySize=settings['memory_size'],
+                                           Timeout=settings['timeout'])
+        conn.get_waiter('function_updated').wait(FunctionName=function_name)
+
+    def configure_mapping(self, conn, mapping_uuid, settings):
+        mapping = self.wait_for_mapping(conn, mapping_uuid)
+        current = (mapping['BatchSize'], mapping.get('MaximumBatchingWindowInSeconds', 0),
+                   mapping.get('ScalingConfig', {}).get('MaximumConcurrency'))
+        # a mapping created before the handler reported batchItemFailures would redeliver whole batches
+        reports_failures = 'ReportBatchItemFailures' in mapping.get('FunctionResponseTypes', [])
+        if current == (settings['batch_size'], settings['batching_window'], settings['max_concurrency']) \
+                and mapping['State'] == 'Enabled' and reports_failures:
+            return
+        print('Setting Lambda-SQS mapping %s to batches of %d, %d seconds window, %s concurrency...'
+              % (mapping_uuid, settings['batch_size'], settings['batching_window'],
+                 settings['max_concurrency'] or 'unreserved'))
+        args = calibrate.mapping_args(settings, mapping)
+        if not reports_failures:
+            args['FunctionResponseTypes'] = ['ReportBatchItemFailures']
+        conn.update_event_source_mapping(UUID=mapping_uuid, Enabled=True, **args)
+        self.wait_for_mapping(conn, mapping_uuid)
+
+    @staticmethod
+    def wait_for_mapping(conn, mapping_uuid, timeout=300):
+        """ the mapping once it is neither being created nor updated """
+        start = time.time()
+        while True:
+            mapping = conn.get_event_source_mapping(UUID=mapping_uuid)
+            if mapping['State'] in ('Enabled', 'Disabled'):
+                return mapping
+            if time.time() - start > timeout:
+                raise RuntimeError('Lambda-SQS mapping %s is still %s' % (mapping_uuid, mapping['State']))
+            time.sleep(1)
+
 
 class DeployItem:
     LOCAL_FILES = 'local_files'
@@ -0,0 +1,116 @@
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+
+class LibraryStore:
+    """Content-addressed library directories on EFS, shared by every task and exec type whose interpreter and
+       requirements are the same. A directory is published atomically by renaming a finished install into place,
+       and deleted when the last deployment referencing it is cleaned up."""
+    DIR_NAME = 'libs'
+    REFS_DIR_NAME = 'refs'
+    LOCK_FILE_NAME = '.lock'
+    # name==version pins the key was computed from, next to the package of an exec type
+    RESOLVED_FILE_NAME = 'resolved_requirements.txt'
+
+    def __init__(self, mount_path):
+        self.root = os.path.join(mount_path, LibraryStore.DIR_NAME)
+
+    @staticmethod
+    def key(python_command, requirements_path, resolved_path):
+        """ interpreter version and platform plus the resolved requirements, so that unpinned requirements get a
+            new key when a dependency is upgraded; the resolved pins are written to resolved_path for the install """
+        version = subprocess.run([python_command, '-c', 'import sys, platform; print(sys.version, platform.machine())'],
+                                 capture_output=True, check=True, text=True).stdout.strip()
+        resolved = LibraryStore.resolve(python_command, requirements_path)
+        with open(resolved_path, 'w') as f:
+            f.write(''.join(r + '\n' for r in resolved))
+        h = hashlib.sha256('\n'.join([version] + resolved).encode()).hexdigest()
+        return '%s-%s' % (version.split()[0], h[:16])
+
+    @staticmethod
+    def resolve(python_command, requirements_path):
+        """ sorted name==version of every package an install of the requirements would bring in (pip 22.2 or later);
+            with an older pip, only fully pinned requirements are accepted and taken as they are """
+        if not os.path.exists(requirements_path):
+            return []
+        result = subprocess.run([python_command, '-m', 'pip', 'install', '--dry-run', '--ignore-installed', '-q',
+                                 '--report', '-', '-r', requirements_path], capture_output=True, text=True)
+        if result.returncode == 0:
+            report = json.loads(result.stdout)
+            return sorted('%s==%s' % (i['metadata']['name'].lower(), i['metadata']['version']) for i in report['install'])
+        with open(requirements_path, 'r') as f:
+            requirements = sorted(set(r.split('#', 1)[0].strip().lower() for r in f.readlines()) - {''})
+        unpinned = [r for r in requirements if '==' not in r]
+        if len(unpinned) > 0:
+            raise RuntimeError('Cannot resolve %s (%s), pin every requirement with == instead: %s'
+                               % (requirements_path, result.stderr.strip().splitlines()[-1:], ', '.join(unpinned)))
+        return requirements
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def publish(self, key, install):
+        """ run install(directory) unless the key is already published, returns False if it was """
+        path = self.path(key)
+        if os.path.exists(path):
+            return False
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = '%s.tmp-%s' % (path, uuid.uuid4().hex[:8])
+        try:
+            install(tmp_path)
+            os.rename(tmp_path, path)
+        except OSError:
+            # a concurrent deploy published the same key first
+            if not os.path.exists(path):
+                raise
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        return True
+
+    @contextmanager
+    def locked(self):
+        """ exclusive lock of the store (EFS supports file locks), held while references are added or released """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, LibraryStore.LOCK_FILE_NAME), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add_ref(self, key, owner):
+        """ record that owner (e.g. <task_id>_<exec_type>) uses the key, returns the reference file; taken before
+            publishing, so that a concurrent release cannot delete the directory in between """
+        ref_dir = os.path.join(self.root, LibraryStore.REFS_DIR_NAME, key)
+        with self.locked():
+            os.makedirs(ref_dir, exist_ok=True)
+            ref_path = os.path.join(ref_dir, owner)
+            open(ref_path, 'w').close()
+        return ref_path
+
+    def release(self, ref_path):
+        """ drop a reference, the library directory is deleted with its last reference """
+        ref_dir = os.path.dirname(ref_path)
+        key = os.path.basename(ref_dir)
+        with self.locked():
+            if os.path.exists(ref_path):
+                os.remove(ref_path)
+            if not os.path.isdir(ref_dir) or len(os.listdir(ref_dir)) > 0:
+                return False
+            os.rmdir(ref_dir)
+            # renamed under the lock, a deploy adding a reference afterwards publishes the key again
+            tomb_path = '%s.deleted-%s' % (self.path(key), uuid.uuid4().hex[:8])
+            if not os.path.exists(self.path(key)):
+                return True
+            os.rename(self.path(key), tomb_path)
+        print('Deleting unreferenced libraries: %s' % key)
+        shutil.rmtree(tomb_path, ignore_errors=True)
+        return True
@@ -0,0 +1,356 @@
+"""Load tests of the trigger, reduce and compare stages against the local stand-ins (see workflow.local).
+
+The real Trigger, Reducer and Comparator classes run against subclasses of LocalSQS and LocalDynamoDB that add
+a latency to every call, emulate throttling (botocore retries throttled requests, so it shows up as extra
+latency) and fail a share of the batch entries, which the callers have to retry. Every case runs in a fresh
+process, so its peak RSS is its own.
+"""
+import io
+import json
+import time
+import random
+import resource
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor
+
+from workflow import result_codec
+from workflow.local import LocalSQS, LocalDynamoDB, _LocalDynamoClient
+from workflow.trigger import Trigger
+from workflow.reduce import Reducer, Comparator
+from workflow.cache import result_id_prefix
+
+TASK_ID = 'loadtest'
+
+DEFAULT_CONFIG = {
+    'stages': ['trigger', 'reduce', 'compare'],
+    # number of data ids, up to 1M
+    'sizes': [1000, 10000, 100000],
+    # model outputs: number of numeric fields, nesting depth and result format
+    'outputs': [
+        {'fields': 10, 'depth': 1, 'format': 'decimal'},
+        {'fields': 100, 'depth': 2, 'format': 'binary'}
+    ],
+    # ids per work unit / completion message
+    'shard_sizes': [1, 10],
+    # pairs per Comparator.compare_batch call in the compare stage
+    'compare_batch_sizes': [100, 1000],
+    'trigger_parallelism': 16,
+    # share of test outputs that differ from the benchmark output
+    'diff_rate': 0.5,
+    'faults': {'latency': 0.0, 'throttle_rate': 0.0, 'failure_rate': 0.0},
+    'baseline': 'load_test_baseline.json',
+    # relative throughput drop / peak RSS growth reported as a regression
+    'tolerance': 0.1
+}
+
+
+class Faults:
+    """latency: seconds added to every call, throttle_rate: chance that an attempt is throttled and retried
+       after a backoff, failure_rate: chance that a batch entry fails"""
+    THROTTLE_BACKOFF = 0.05
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def call(self):
+        attempt = 0
+        while self.chance(self.throttle_rate):
+            with self.lock:
+                self.throttled += 1
+            time.sleep(min(Faults.THROTTLE_BACKOFF * (2 ** attempt), 2))
+            attempt += 1
+        with self.lock:
+            self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def fails(self):
+        if not self.chance(self.failure_rate):
+            return False
+        with self.lock:
+            self.failed += 1
+        return True
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def counts(self):
+        return {'calls': self.calls, 'throttled': self.throttled, 'failed': self.failed}
+
+
+class FaultySQS(LocalSQS):
+    def __init__(self, faults):
+        super().__init__()
+        self.faults = faults
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.faults.call()
+        return super().send_message(QueueUrl, MessageBody, **kwargs)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.faults.call()
+        failed = [e for e in Entries if self.faults.fails()]
+        failed_ids = set(e['Id'] for e in failed)
+        response = super().send_message_batch(QueueUrl, [e for e in Entries if e['Id'] not in failed_ids])
+        response['Failed'] = [{'Id': e['Id'], 'SenderFault': False, 'Code': 'InternalError'} for e in failed]
+        return response
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        self.faults.call()
+        return super().receive_message(QueueUrl, MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds, **kwargs)
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.faults.call()
+        return super().delete_message_batch(QueueUrl, Entries)
+
+
+class FaultyDynamoDB(LocalDynamoDB):
+    def __init__(self, faults):
+        super().__init__()
+        self.faults = faults
+        self.meta.client = _FaultyDynamoClient(self, faults)
+
+
+class _FaultyDynamoClient(_LocalDynamoClient):
+    def __init__(self, resource, faults):
+        super().__init__(resource)
+        self.faults = faults
+
+    def batch_get_item(self, RequestItems):
+        self.faults.call()
+        unprocessed = {}
+        request_items = {}
+        for table_name, request in RequestItems.items():
+            keys = [k for k in request['Keys'] if not self.faults.fails()]
+            if len(keys) < len(request['Keys']):
+                unprocessed[table_name] = {'Keys': [k for k in request['Keys'] if k not in keys]}
+            request_items[table_name] = {'Keys': keys}
+        response = super().batch_get_item(request_items)
+        response['UnprocessedKeys'] = unprocessed
+        return response
+
+    def batch_write_item(self, RequestItems):
+        self.faults.call()
+        unprocessed = {}
+        request_items = {}
+        for table_name, requests in RequestItems.items():
+            kept = [r for r in requests if not self.faults.fails()]
+            if len(kept) < len(requests):
+                unprocessed[table_name] = [r for r in requests if r not in kept]
+            request_items[table_name] = kept
+        response = super().batch_write_item(request_items)
+        response['UnprocessedItems'] = unprocessed
+        return response
+
+
+def make_output(rng, fields, depth):
+    """ nested dict with fields float leaves, split into groups of 10 per level below the top """
+    def build(names, level):
+        if level <= 1 or len(names) <= 10:
+            return {n: rng.random() for n in names}
+        group = -(-len(names) // 10)
+        return {'g%d' % i: build(names[x:x + group], level - 1) for i, x in enumerate(range(0, len(names), group))}
+    return build(['f%d' % i for i in range(fields)], depth)
+
+
+def changed_output(rng, output):
+    """ copy of output with one leaf changed """
+    output = json.loads(json.dumps(output))
+    node = output
+    while True:
+        k = rng.choice(list(node))
+        if not isinstance(node[k], dict):
+            node[k] += 1.0
+            return output
+        node = node[k]
+
+
+def stored(output, result_format):
+    """ the item data the handler writes for output (see lambda_function.py.j2) """
+    if result_format == 'binary':
+        return result_codec.encode(output)
+    return json.loads(json.dumps(output), parse_float=Decimal)
+
+
+def output_pairs(n, shape, diff_rate, seed=0):
+    rng = random.Random(seed)
+    for _ in range(n):
+        a = make_output(rng, shape['fields'], shape['depth'])
+        b = changed_output(rng, a) if rng.random() < diff_rate else a
+        yield a, b
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_trigger(case, config):
+    faults = Faults(**config['faults'])
+    sqs = FaultySQS(faults)
+    queue_url = sqs.create_queue(QueueName=TASK_ID + '_test')['QueueUrl']
+    ids = [str(i) for i in range(case['size'])]
+    trigger = Trigger(config['trigger_parallelism'], sqs=sqs, shard_size=case['shard_size'])
+    start = time.time()
+    trigger.run(ids, [queue_url])
+    elapsed = time.time() - start
+    messages = len(sqs.queues[queue_url])
+    return {'seconds': elapsed, 'messages': messages, 'messages_per_sec': messages / elapsed,
+            'ids_per_sec': trigger.sent * case['size'] / max(1, messages) / elapsed, 'faults': faults.counts()}
+
+
+def run_reduce(case, config):
+    """ results of both exec types are in the result table and their completion messages queued,
+        only Reducer.run is timed """
+    faults = Faults(**config['faults'])
+    sqs = FaultySQS(faults)
+    dynamo = FaultyDynamoDB(faults)
+    queue_url = sqs.create_queue(QueueName=TASK_ID + '_completion')['QueueUrl']
+    table = dynamo.Table(Reducer.RESULT_TABLE)
+    ids = [str(i) for i in range(case['size'])]
+    prefixes = {e: result_id_prefix(TASK_ID, e) for e in ('benchmark', 'test')}
+    for data_id, (a, b) in zip(ids, output_pairs(case['size'], case['output'], config['diff_rate'])):
+        for exec_type, output in (('benchmark', a), ('test', b)):
+            table.put_item(Item={'result_id': prefixes[exec_type] + data_id, 'data_id': data_id,
+                                 'exec_type': exec_type, 'task_id': TASK_ID,
+                                 'data': stored(output, case['output']['format'])})
+    shard_size = case['shard_size']
+    # the setup is not subject to the injected faults
+    for prefix in prefixes.values():
+        result_ids = [prefix + i for i in ids]
+        for x in range(0, len(result_ids), shard_size):
+            shard = result_ids[x:x + shard_size]
+            LocalSQS.send_message(sqs, queue_url, shard[0] if shard_size <= 1 else json.dumps(shard))
+    messages = len(sqs.queues[queue_url])
+
+    reducer = Reducer({}, TASK_ID, queue_url, ids, sqs=sqs, dynamo=dynamo)
+    reducer.idle_threshold = 10
+    start = time.time()
+    reducer.run()
+    elapsed = time.time() - start
+    return {'seconds': elapsed, 'messages': messages, 'messages_per_sec': messages / elapsed,
+            'results_per_sec': (case['size'] - reducer.remaining()) / elapsed, 'faults': faults.counts()}
+
+
+def run_compare(case, config):
+    pairs = [(stored(a, case['output']['format']), stored(b, case['output']['format']))
+             for a, b in output_pairs(case['size'], case['output'], config['diff_rate'])]
+    comparator = Comparator()
+    batch_size = case['batch_size']
+    start = time.time()
+    for x in range(0, len(pairs), batch_size):
+        comparator.compare_batch(pairs[x:x + batch_size])
+    elapsed = time.time() - start
+    return {'seconds': elapsed, 'results_per_sec': len(pairs) / elapsed,
+            'cases_with_diffs': comparator.total_test_cases_with_diffs}
+
+
+STAGES = {'trigger': run_trigger, 'reduce': run_reduce, 'compare': run_compare}
+
+
+def run_case(case, config):
+    """ runs in a separate process, the stages' own output is discarded """
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = STAGES[case['stage']](case, config)
+    result['total_seconds'] = time.time() - start
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def cases(config):
+    """ the sweep: trigger by size and shard size, reduce by size, output and shard size,
+        compare by size, output and batch size """
+    for stage in config['stages']:
+        for size in config['sizes']:
+            if stage == 'trigger':
+                for shard_size in config['shard_sizes']:
+                    yield {'stage': stage, 'size': size, 'shard_size': shard_size}
+                continue
+            for output in config['outputs']:
+                if stage == 'reduce':
+                    for shard_size in config['shard_sizes']:
+                        yield {'stage': stage, 'size': size, 'output': output, 'shard_size': shard_size}
+                else:
+                    for batch_size in config['compare_batch_sizes']:
+                        yield {'stage': stage, 'size': size, 'output': output, 'batch_size': batch_size}
+
+
+def case_name(case):
+    name = '%s/n=%d' % (case['stage'], case['size'])
+    if 'output' in case:
+        name += '/%(fields)dx%(depth)d-%(format)s' % case['output']
+    if 'shard_size' in case:
+        name += '/shard=%d' % case['shard_size']
+    if 'batch_size' in case:
+        name += '/batch=%d' % case['batch_size']
+    return name
+
+
+def throughput(result):
+    """ results/sec of the reduce and compare stages, ids/sec of the trigger stage """
+    return result.get('results_per_sec', result.get('ids_per_sec', 0))
+
+
+def run(config):
+    """ {case name: result} for every case of the sweep """
+    results = {}
+    print("{0:>50} {1:>10} {2:>12} {3:>12} {4:>10}".format("case", "seconds", "messages/s", "ids/s", "rss MB"))
+    # spawned rather than forked, so a case does not inherit the memory of the ones before it
+    context = multiprocessing.get_context('spawn')
+    for case in cases(config):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case, config).result()
+        name = case_name(case)
+        results[name] = result
+        print("{0:>50} {1:>10.2f} {2:>12.1f} {3:>12.1f} {4:>10.1f}".format(
+            name, result['total_seconds'], result.get('messages_per_sec', 0), throughput(result),
+            result['peak_rss_mb']))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_baseline(results, config, path):
+    with open(path, 'w') as f:
+        json.dump({'commit': git_commit(), 'created': time.time(), 'config': config, 'results': results}, f, indent=2)
+
+
+def compare_baseline(results, path, tolerance):
+    """ print throughput and peak RSS against the baseline, returns the names of the regressed cases """
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+    print("Baseline: %s" % baseline.get('commit'))
+    print("{0:>50} {1:>12} {2:>12} {3:>10}".format("case", "throughput", "rss", ""))
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]
+        speed = throughput(result) / throughput(before) - 1 if throughput(before) > 0 else 0
+        rss = result['peak_rss_mb'] / before['peak_rss_mb'] - 1 if before['peak_rss_mb'] > 0 else 0
+        regressed = speed < -tolerance or rss > tolerance
+        if regressed:
+            regressions.append(name)
+        print("{0:>50} {1:>+11.1f}% {2:>+11.1f}% {3:>10}".format(name, speed * 100, rss * 100,
+                                                                  "REGRESSION" if regressed else ""))
+    return regressions
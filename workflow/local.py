@@ -0,0 +1,509 @@
+import os
+import sys
+import json
+import time
+import traceback
+import zlib
+import fcntl
+import uuid
+import bisect
+import pickle
+import threading
+import subprocess
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from types import SimpleNamespace
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+from workflow.deploy import Deploy, DeployItem
+from workflow import result_codec
+from workflow.dataset import Dataset, dataset_path
+from workflow.cache import load_cache_keys, result_id_prefix, RESULT_ID_PREFIX
+from workflow.libstore import LibraryStore
+from workflow import variants
+
+
+class LocalSQS:
+    """In-process stand-in for the subset of the boto3 SQS client used by the workflow"""
+    URL_PREFIX = 'local://sqs/'
+
+    def __init__(self):
+        self.queues = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def create_queue(self, QueueName, Attributes=None):
+        queue_url = LocalSQS.URL_PREFIX + QueueName
+        with self.lock:
+            self.queues.setdefault(queue_url, deque())
+            self.in_flight.setdefault(queue_url, {})
+        return {'QueueUrl': queue_url}
+
+    def delete_queue(self, QueueUrl):
+        with self.lock:
+            self.queues.pop(QueueUrl, None)
+            self.in_flight.pop(QueueUrl, None)
+
+    def purge_queue(self, QueueUrl):
+        with self.lock:
+            self.queues[QueueUrl].clear()
+            self.in_flight[QueueUrl].clear()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            self.queues[QueueUrl].append(self._message(message_id, MessageBody, kwargs))
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = []
+        with self.lock:
+            for e in Entries:
+                message_id = str(uuid.uuid4())
+                self.queues[QueueUrl].append(self._message(message_id, e['MessageBody'], e))
+                successful.append({'Id': e['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0, **kwargs):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            with self.lock:
+                self._requeue_expired(QueueUrl)
+                queue = self.queues[QueueUrl]
+                messages = []
+                while len(queue) > 0 and len(messages) < MaxNumberOfMessages:
+                    m = queue.popleft()
+                    m['ReceiptHandle'] = str(uuid.uuid4())
+                    self.in_flight[QueueUrl][m['ReceiptHandle']] = (time.time() + VisibilityTimeout, m)
+                    messages.append(dict(m))
+            if len(messages) > 0:
+                return {'Messages': messages}
+            if time.time() >= deadline:
+                return {}
+            time.sleep(min(0.05, max(0.0, deadline - time.time())))
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful = []
+        failed = []
+        with self.lock:
+            in_flight = self.in_flight[QueueUrl]
+            for e in Entries:
+                if in_flight.pop(e['ReceiptHandle'], None) is None:
+                    failed.append({'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+                else:
+                    successful.append({'Id': e['Id']})
+        return {'Successful': successful, 'Failed': failed}
+
+    def _requeue_expired(self, queue_url):
+        now = time.time()
+        in_flight = self.in_flight[queue_url]
+        for rh in [rh for rh, (visible_at, _) in in_flight.items() if visible_at <= now]:
+            _, m = in_flight.pop(rh)
+            self.queues[queue_url].append(m)
+
+    @staticmethod
+    def _message(message_id, body, entry):
+        return {
+            'MessageId': message_id,
+            'Body': body,
+            'Attributes': {'SentTimestamp': str(int(time.time() * 1000))},
+            'MessageAttributes': entry.get('MessageAttributes', {})
+        }
+
+
+class LocalTable:
+    """In-process stand-in for a boto3 DynamoDB Table resource keyed by a single hash key"""
+
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_item(self, Key):
+        item = self.items.get(Key[self.key])
+        return {} if item is None else {'Item': item}
+
+    def put_item(self, Item):
+        with self.lock:
+            self.items[Item[self.key]] = Item
+        return {}
+
+    def delete_item(self, Key):
+        with self.lock:
+            self.items.pop(Key[self.key], None)
+        return {}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _LocalBatchWriter(self)
+
+
+class _LocalBatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+
+class LocalDynamoDB:
+    """In-process stand-in for the boto3 DynamoDB service resource and its `meta.client`"""
+    KEY_SCHEMA = {
+        'backtesting-data': 'data_id',
+        'backtesting-result': 'result_id'
+    }
+
+    def __init__(self):
+        self.tables = {}
+        self.meta = SimpleNamespace(client=_LocalDynamoClient(self))
+
+    def __getstate__(self):
+        return {'tables': self.tables}
+
+    def __setstate__(self, state):
+        self.tables = state['tables']
+        self.meta = SimpleNamespace(client=_LocalDynamoClient(self))
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = LocalTable(name, LocalDynamoDB.KEY_SCHEMA.get(name, 'id'))
+        return self.tables[name]
+
+
+class _LocalDynamoClient:
+    # a scan page holds up to 1MB, approximated by a number of items
+    SCAN_PAGE_SIZE = 1000
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.resource.Table(table_name)
+            responses[table_name] = [table.items[k[table.key]] for k in request['Keys'] if k[table.key] in table.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        for table_name, requests in RequestItems.items():
+            table = self.resource.Table(table_name)
+            for r in requests:
+                if 'PutRequest' in r:
+                    table.put_item(Item=r['PutRequest']['Item'])
+                else:
+                    table.delete_item(Key=r['DeleteRequest']['Key'])
+        return {'UnprocessedItems': {}}
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, ExclusiveStartKey=None, Limit=None, FilterExpression=None,
+             ExpressionAttributeValues=None):
+        """ items are assigned to segments by a hash of their key and paged in key order,
+            FilterExpression supports 'a = :v' and 'begins_with(a, :v)' terms joined by OR """
+        table = self.resource.Table(TableName)
+        keys = sorted(k for k in list(table.items) if zlib.crc32(str(k).encode()) % TotalSegments == Segment)
+        if ExclusiveStartKey is not None:
+            keys = keys[bisect.bisect_right(keys, ExclusiveStartKey[table.key]):]
+        limit = Limit or _LocalDynamoClient.SCAN_PAGE_SIZE
+        page = keys[:limit]
+        items = [table.items[k] for k in page if k in table.items]
+        if FilterExpression is not None:
+            terms = [_LocalDynamoClient.filter_term(t, ExpressionAttributeValues or {}) for t in FilterExpression.split(' OR ')]
+            items = [item for item in items if any(t(item) for t in terms)]
+        response = {'Items': items, 'Count': len(items), 'ScannedCount': len(page)}
+        if len(keys) > limit:
+            response['LastEvaluatedKey'] = {table.key: page[-1]}
+        return response
+
+    @staticmethod
+    def filter_term(term, values):
+        term = term.strip()
+        if term.startswith('begins_with('):
+            name, value = [t.strip() for t in term[len('begins_with('):-1].split(',')]
+            return lambda item: str(item.get(name, '')).startswith(values[value])
+        name, value = [t.strip() for t in term.split('=')]
+        return lambda item: item.get(name) == values[value]
+
+
+class LocalState:
+    """Local tables and queues, pickled into the task workspace so that separate stages can share them.
+       Cached benchmark results (see workflow.cache) are also kept in the workspace root, shared by every task."""
+    DIR_NAME = 'local_state'
+    FILE_NAME = 'state.pickle'
+    SHARED_CACHE_FILE_NAME = 'local_cached_results.pickle'
+
+    def __init__(self, task_workspace):
+        self.path = os.path.join(task_workspace, LocalState.DIR_NAME, LocalState.FILE_NAME)
+        self.shared_cache_path = os.path.join(os.path.dirname(os.path.normpath(task_workspace)),
+                                              LocalState.SHARED_CACHE_FILE_NAME)
+        self.sqs = LocalSQS()
+        self.dynamo = LocalDynamoDB()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.sqs, self.dynamo = pickle.load(f)
+        results = self.dynamo.Table('backtesting-result').items
+        with self.shared_cache() as cached:
+            for result_id, item in cached.items():
+                results.setdefault(result_id, item)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((self.sqs, self.dynamo), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        results = self.dynamo.Table('backtesting-result').items
+        new = {k: v for k, v in list(results.items()) if k.startswith(RESULT_ID_PREFIX)}
+        with self.shared_cache() as cached:
+            new = {k: v for k, v in new.items() if k not in cached}
+            if len(new) == 0:
+                return
+            cached.update(new)
+            tmp_path = self.shared_cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.shared_cache_path)
+
+    @contextmanager
+    def shared_cache(self):
+        """ {result_id: item} of the cached results of every task, locked against concurrent saves """
+        os.makedirs(os.path.dirname(self.shared_cache_path), exist_ok=True)
+        with open(self.shared_cache_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                cached = {}
+                if os.path.exists(self.shared_cache_path):
+                    with open(self.shared_cache_path, 'rb') as f:
+                        cached = pickle.load(f)
+                yield cached
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class LocalDeploy(Deploy):
+    """Checks out the benchmark and test packages into the task workspace and creates a local completion queue.
+       Nothing is deployed to Lambda, SQS or EFS."""
+
+    def __init__(self, deploy_config, task_config, state=None):
+        super().__init__(deploy_config, task_config)
+        self.state = state if state is not None else LocalState(self.task_workspace)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.state.save()
+
+    def sub_pipeline(self, exec_type='benchmark'):
+        exec_location = os.path.join(self.task_workspace, exec_type)
+        os.makedirs(exec_location, exist_ok=True)
+
+        package_location = os.path.join(exec_location, 'package')
+        requirements = os.path.join(package_location, 'requirements.txt')
+        self.step(exec_type, 'fetch_source', self.fetch_source, exec_type, package_location)
+        self.step(exec_type, 'fetch_files', self.fetch_files, exec_type, package_location)
+        # the libraries are installed with the current interpreter, which the cache key has to reflect
+        self.library_keys[exec_type] = self.step(exec_type, 'library_key', LibraryStore.key, sys.executable,
+                                                 requirements,
+                                                 os.path.join(exec_location, LibraryStore.RESOLVED_FILE_NAME))
+        self.step(exec_type, 'record_cache_key', self.record_cache_key, exec_type, package_location)
+        self.step(exec_type, 'deploy_libraries', self.deploy_libraries, sys.executable, requirements, exec_type)
+
+    def deploy_libraries(self, python_command, requirements, exec_type):
+        print('Installing dependencies locally...')
+        lib_location = os.path.join(self.task_workspace, exec_type, 'lib')
+        os.makedirs(lib_location, exist_ok=True)
+        if os.path.exists(requirements):
+            subprocess.run([python_command, '-m', 'pip', 'install', '-q', '-r', requirements, '-t', lib_location])
+        self.register_deployed(DeployItem.LOCAL_FILES, lib_location)
+
+    def create_sqs(self, queue_name, fifo=False, visibility_timeout=None):
+        print('Creating local queue "%s"...' % queue_name)
+        queue_url = self.state.sqs.create_queue(QueueName=queue_name)['QueueUrl']
+        self.state.sqs.purge_queue(QueueUrl=queue_url)
+        self.register_deployed(DeployItem.SQS_QUEUE, queue_url)
+        return queue_url, queue_url
+
+    def clean_up(self):
+        try:
+            super().clean_up()
+        finally:
+            self.state.save()
+
+    def clean_up_item(self, t):
+        if t[0] == DeployItem.SQS_QUEUE:
+            print('Deleting local queue: %s' % t[1])
+            self.state.sqs.delete_queue(QueueUrl=t[1])
+        else:
+            super().clean_up_item(t)
+
+    def configure_lambda(self, function_name, mapping_uuid, settings):
+        print('No Lambda function "%s" to configure locally' % function_name)
+
+    def stop_item(self, t):
+        if t[0] == DeployItem.SQS_QUEUE and t[1].find('_completion') < 0:
+            print('Purging local queue: %s' % t[1])
+            self.state.sqs.purge_queue(QueueUrl=t[1])
+        elif t[0] != DeployItem.SQS_QUEUE:
+            super().stop_item(t)
+
+
+_model = None
+_result_format = None
+
+
+def _init_worker(package_location, lib_location, result_format=('decimal', True)):
+    global _model, _result_format
+    sys.path.insert(0, lib_location)
+    sys.path.insert(0, package_location)
+    from model import Model
+    _model = Model()
+    _result_format = result_format
+
+
+def _run_model(record):
+    """ (data_id, output, run seconds), output None when the model fails, as the Lambda handler isolates
+        failures per record """
+    data_id, data = record
+    start = time.time()
+    try:
+        output = _model.run(data)
+        run_seconds = time.time() - start
+        result_format, compress = _result_format
+        encoded = result_codec.encode(output, compress=compress) if result_format == 'binary' else None
+        if encoded is not None:
+            return data_id, encoded, run_seconds
+        # same float -> Decimal conversion as the Lambda handler
+        return data_id, json.loads(json.dumps(output), parse_float=Decimal), run_seconds
+    except Exception:
+        print('Failed to process data item %s' % data_id)
+        traceback.print_exc()
+        return data_id, None, time.time() - start
+
+
+class LocalExecutor:
+    """Runs the benchmark and test models over the historical data in a multiprocessing pool and
+       writes results and completion signals to the local stand-ins, in place of Lambda"""
+
+    def __init__(self, deploy_config, task_config, state=None, processes=None):
+        self.task_id = task_config['task_id']
+        self.task_workspace = os.path.join(deploy_config['workspace_path'], self.task_id)
+        self.state = state if state is not None else LocalState(self.task_workspace)
+        self.processes = processes or deploy_config.get('local_processes') or os.cpu_count()
+        self.completion_queue_url = LocalSQS.URL_PREFIX + self.task_id + '_completion'
+        self.result_format = (task_config.get('result_format', 'decimal'), task_config.get('result_compression', True))
+        self.shard_size = deploy_config.get('shard_size', 1)
+        self.dataset_location = dataset_path(deploy_config['workspace_path'], self.task_id) \
+            if task_config.get('dataset') == 'efs' else None
+        self.cache_keys = load_cache_keys(self.task_workspace)
+        self.exec_types = variants.exec_types(task_config)
+
+    def run(self, data_ids, exec_types=None):
+        """ exec_types: the benchmark and every test variant by default """
+        exec_types = exec_types or self.exec_types
+        start = time.time()
+        per_pool = max(1, self.processes // len(exec_types))
+        try:
+            with ThreadPoolExecutor(max_workers=len(exec_types)) as executor:
+                futures = [executor.submit(self.execute, exec_type, data_ids, per_pool) for exec_type in exec_types]
+                n = sum(f.result() for f in futures)
+        finally:
+            self.state.save()
+        elapsed = time.time() - start
+        print("Executed %d records in %.2f seconds (%.1f records/sec)" % (n, elapsed, n / elapsed if elapsed > 0 else 0))
+
+    def execute(self, exec_type, data_ids, processes):
+        exec_location = os.path.join(self.task_workspace, exec_type)
+        data_table = self.state.dynamo.Table('backtesting-data')
+        result_table = self.state.dynamo.Table('backtesting-result')
+        sqs = self.state.sqs
+        prefix = result_id_prefix(self.task_id, exec_type, self.cache_keys.get(exec_type))
+        if exec_type in self.cache_keys:
+            # results cached by an earlier task with the same package are not computed again
+            cached = [i for i in data_ids if prefix + i in result_table.items]
+            print("%d %s results are cached" % (len(cached), exec_type))
+            data_ids = [i for i in data_ids if prefix + i not in result_table.items]
+
+        def records():
+            # ids missing from the data are skipped, as the Lambda handler does
+            if self.dataset_location is not None:
+                dataset = Dataset(self.dataset_location)
+                for data_id in data_ids:
+                    try:
+                        row = dataset.row_of(data_id)
+                    except KeyError:
+                        print('Data item %s not found, skipped' % data_id)
+                        continue
+                    yield data_id, dataset.rows(row, row + 1)[1][0]
+                return
+            for data_id in data_ids:
+                item = data_table.get_item(Key={'data_id': data_id}).get('Item')
+                if item is None:
+                    print('Data item %s not found, skipped' % data_id)
+                    continue
+                yield data_id, item['data']
+
+        def signal(body, run_seconds):
+            # run timing attribute in the handler's format, read by the reducer's metrics
+            sqs.send_message(QueueUrl=self.completion_queue_url, MessageBody=body, MessageAttributes={
+                'timings': {'DataType': 'String', 'StringValue': json.dumps({'run': run_seconds})}})
+
+        n = 0
+        failed = 0
+        shard = []
+        shard_seconds = 0.0
+        with multiprocessing.Pool(processes, _init_worker, (os.path.join(exec_location, 'package'),
+                                                            os.path.join(exec_location, 'lib'),
+                                                            self.result_format)) as pool:
+            for data_id, output, run_seconds in pool.imap_unordered(_run_model, records(), chunksize=16):
+                if output is None:
+                    failed += 1
+                    continue
+                result_id = prefix + data_id
+                result_table.put_item(Item={'result_id': result_id, 'data_id': data_id, 'exec_type': exec_type,
+                                            'task_id': self.task_id, 'data': output})
+                n += 1
+                if self.shard_size <= 1:
+                    signal(result_id, run_seconds)
+                    continue
+                # one completion message per shard listing its result ids, as the sharded Lambda handler does
+                shard.append(result_id)
+                shard_seconds += run_seconds
+                if len(shard) == self.shard_size:
+                    signal(json.dumps(shard), shard_seconds)
+                    shard = []
+                    shard_seconds = 0.0
+            if len(shard) > 0:
+                signal(json.dumps(shard), shard_seconds)
+        print("%d %s records executed" % (n, exec_type))
+        if failed > 0:
+            print("%d %s records failed" % (failed, exec_type))
+        return n
+
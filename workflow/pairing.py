@@ -0,0 +1,160 @@
+"""Bounded-memory pairing of benchmark and test results in the reducer.
+
+The pending data ids are kept as one sorted NumPy array of byte strings with a bitmap of the ids still pending,
+instead of a set of Python strings. Results waiting for their partner are held in memory up to a budget; beyond
+it the oldest ones are spilled to an SQLite file and read back when their partner arrives.
+"""
+import os
+import pickle
+import sqlite3
+import tempfile
+import numpy as np
+
+
+class PendingIds:
+    """Set of data ids that have not been compared yet, each id has a fixed index"""
+
+    def __init__(self, ids):
+        self.ids = np.unique(np.array([i.encode() for i in ids], dtype=bytes))
+        self.pending = np.ones(len(self.ids), dtype=bool)
+        self.count = len(self.ids)
+
+    def copy(self):
+        """ the same ids with their own pending bitmap, the ids array is shared """
+        other = PendingIds([])
+        other.ids = self.ids
+        other.pending = self.pending.copy()
+        other.count = self.count
+        return other
+
+    def index(self, data_id):
+        """ index of a pending id, -1 when it is unknown or done """
+        key = data_id.encode()
+        i = int(np.searchsorted(self.ids, key))
+        if i < len(self.ids) and self.ids[i] == key and self.pending[i]:
+            return i
+        return -1
+
+    def __contains__(self, data_id):
+        return self.index(data_id) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (i.decode() for i in self.ids[self.pending])
+
+    def remove_index(self, i):
+        if self.pending[i]:
+            self.pending[i] = False
+            self.count -= 1
+
+    def remove(self, data_id):
+        i = self.index(data_id)
+        if i < 0:
+            raise KeyError(data_id)
+        self.remove_index(i)
+
+    def __isub__(self, data_ids):
+        for data_id in data_ids:
+            i = self.index(data_id)
+            if i >= 0:
+                self.remove_index(i)
+        return self
+
+
+def payload_size(data):
+    """ rough in-memory size of a result: Binary / bytes blobs or nested dicts of Decimals """
+    data = getattr(data, 'value', data)
+    if isinstance(data, (bytes, bytearray)):
+        return len(data) + 40
+    if isinstance(data, dict):
+        return 100 + sum(len(k) + 60 + payload_size(v) for k, v in data.items())
+    return 100
+
+
+class PairingStore:
+    """Results waiting for their partner, keyed by the index of their data id in a PendingIds"""
+    # spill down to this share of the budget, so that spills happen in batches
+    SPILL_TARGET = 0.75
+
+    def __init__(self, pending_ids, memory_budget_mb=512, spill_dir=None):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.spill_dir = spill_dir
+        self.memory = {}
+        self.memory_size = 0
+        self.spilled = np.zeros(len(pending_ids.ids), dtype=bool)
+        self.db = None
+        self.db_path = None
+        self.parked = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.spill_count = 0
+        self.peak_memory_size = 0
+
+    def add(self, i, exec_type, data):
+        """ returns the (benchmark, test) pair once both results of data id i are in, None until then """
+        if i in self.memory:
+            other_type, other, size = self.memory[i]
+            if other_type == exec_type:
+                # a result delivered again replaces the one waiting
+                self.memory[i] = (exec_type, data, size)
+                return None
+            del self.memory[i]
+            self.memory_size -= size
+            self.memory_hits += 1
+            return (other, data) if other_type == 'benchmark' else (data, other)
+        if self.spilled[i]:
+            other_type, other = pickle.loads(self.db.execute('SELECT data FROM halves WHERE id = ?', (i,)).fetchone()[0])
+            if other_type == exec_type:
+                return None
+            self.db.execute('DELETE FROM halves WHERE id = ?', (i,))
+            self.spilled[i] = False
+            self.disk_hits += 1
+            return (other, data) if other_type == 'benchmark' else (data, other)
+        size = payload_size(data)
+        self.memory[i] = (exec_type, data, size)
+        self.memory_size += size
+        self.parked += 1
+        self.peak_memory_size = max(self.peak_memory_size, self.memory_size)
+        if self.memory_size > self.memory_budget:
+            self.spill()
+        return None
+
+    def spill(self):
+        """ move the results that have waited longest to disk """
+        if self.db is None:
+            fd, self.db_path = tempfile.mkstemp(prefix='pairing_', suffix='.sqlite', dir=self.spill_dir)
+            os.close(fd)
+            self.db = sqlite3.connect(self.db_path)
+            self.db.execute('PRAGMA journal_mode = OFF')
+            self.db.execute('PRAGMA synchronous = OFF')
+            self.db.execute('CREATE TABLE halves (id INTEGER PRIMARY KEY, data BLOB)')
+        rows = []
+        # dicts keep insertion order, so the first entries are the oldest
+        for i in list(self.memory):
+            if self.memory_size <= self.memory_budget * PairingStore.SPILL_TARGET:
+                break
+            exec_type, data, size = self.memory.pop(i)
+            self.memory_size -= size
+            rows.append((i, pickle.dumps((exec_type, data), protocol=pickle.HIGHEST_PROTOCOL)))
+            self.spilled[i] = True
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO halves VALUES (?, ?)', rows)
+        self.spill_count += len(rows)
+
+    def print_stats(self):
+        matched = self.memory_hits + self.disk_hits
+        print("Pairing: %d results waited for their partner, %d matched in memory, %d on disk, "
+              "%d spilled (%.1f%%), peak %.1f MB in memory"
+              % (self.parked, self.memory_hits, self.disk_hits, self.spill_count,
+                 100.0 * self.spill_count / self.parked if self.parked > 0 else 0,
+                 self.peak_memory_size / 1024.0 / 1024.0))
+        if matched > 0:
+            print("Pairing hit rate: %.1f%% in memory" % (100.0 * self.memory_hits / matched))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.db_path)
+            self.db = None
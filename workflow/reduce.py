@@ -1,137 +1,807 @@
 import boto3
+import json
 import time
+import queue
+import numbers
+import threading
+import numpy as np
+
+from workflow import result_codec
+from workflow.cache import result_id_prefix
+from workflow.pairing import PendingIds, PairingStore
 
 
 class Reducer:
-    def __init__(self, deploy_config, task_id, completion_queue_url, ids):
+    RESULT_TABLE = 'backtesting-result'
+    MAX_RETRIES = 8
+    # batch_get_item accepts up to 100 keys per request
+    FETCH_BATCH_SIZE = 100
+    # missing ids read from the result table at a time when resuming
+    READ_MISSING_BATCH_SIZE = 10000
+
+    def __init__(self, deploy_config, task_id, completion_queue_url, ids, sqs=None, dynamo=None, benchmark_cache_key=None,
+                 checkpoint=None, variants=('test',)):
+        # pipeline sizing, can be overridden in deploy_config.json
+        self.reducer_receivers = 4
+        self.reducer_fetchers = 2
+        self.reducer_queue_size = 64
+        # JSON export of the stage timings, see ReduceMetrics
+        self.metrics_path = None
+        # seconds between checkpoints, when a checkpoint (see workflow.checkpoint) is given
+        self.checkpoint_interval = 30
+        # parallel scan segments of the result table in harvest()
+        self.harvest_segments = 8
+        # results waiting for their partner beyond this are spilled to disk, see workflow.pairing
+        self.pairing_memory_mb = 512
+        self.pairing_spill_dir = None
         for k, v in deploy_config.items():
             setattr(self, k, v)
         self.completion_queue_url = completion_queue_url
         self.task_id = task_id
-        self.ids = set(ids)
-        if '' in self.ids:
-            self.ids.remove('')
+        # test exec types compared against the benchmark (see workflow.variants), each with its own pending ids
+        self.variants = list(variants)
+        ids = PendingIds(i for i in ids if i != '')
+        self.pending = {v: ids.copy() for v in self.variants}
         self.idle_threshold = 60
+        # injectable stand-ins for the boto3 SQS client and DynamoDB resource (see workflow.local)
+        self.sqs = sqs
+        self.dynamo = dynamo
+        # cached benchmark results (see workflow.cache) are fetched together with the test results
+        self.benchmark_cache_key = benchmark_cache_key
+        self.checkpoint = checkpoint
+        # optional workflow.sampling.EarlyStop, and the callable that stops the Lambda processing once it decides
+        self.early_stop = None
+        self.stop_work = None
+        # {variant: (decision, reason)}
+        self.decisions = {}
+
+    def remaining(self):
+        """ number of (variant, data id) comparisons still to do """
+        return sum(len(p) for p in self.pending.values())
 
-    def run(self):
+    def comparators(self):
+        return {v: Comparator() for v in self.variants}
+
+    def run(self, resume=False):
+        """ receive -> fetch -> compare -> delete pipeline connected by bounded queues:
+            several long-polling receivers feed fetchers that coalesce result ids into batch_get_item calls,
+            results are compared on this thread and the handled messages are deleted in the background.
+            resume: continue from the checkpoint, the missing ids are first read from the result table
+            as their completion messages may already be deleted """
         start = time.time()
-        comparator = Comparator()
+        comparators = self.comparators()
+        self.metrics = ReduceMetrics()
+        sqs = self.sqs if self.sqs is not None else boto3.client('sqs')
+        dynamo = self.dynamo if self.dynamo is not None else boto3.resource('dynamodb')
+        stores = self.pairing_stores()
+        n = self.remaining()
+        if self.checkpoint is not None and resume:
+            for v, finished_ids in self.checkpoint.load(comparators).items():
+                if v in self.pending:
+                    self.pending[v] -= finished_ids
+            print("Resuming: %d / %d tasks already processed" % (n - self.remaining(), n))
+        elif self.checkpoint is not None:
+            self.checkpoint.reset()
+        # diffs and ids since the last checkpoint
+        delta = self.comparators()
+        finished = {v: [] for v in self.variants}
+        last_checkpoint = time.time()
+        last_check = time.time()
+        if resume:
+            self.read_missing(dynamo, delta, stores, finished)
+        self.stop = threading.Event()
+        self.last_received = time.time()
+        received_queue = queue.Queue(self.reducer_queue_size)
+        fetched_queue = queue.Queue(self.reducer_queue_size)
+        delete_queue = queue.Queue(self.reducer_queue_size)
+        workers = [threading.Thread(target=self.receive, args=(sqs, received_queue), daemon=True)
+                   for _ in range(self.reducer_receivers)]
+        workers += [threading.Thread(target=self.fetch, args=(dynamo, received_queue, fetched_queue), daemon=True)
+                    for _ in range(self.reducer_fetchers)]
+        deleter = threading.Thread(target=self.delete, args=(sqs, delete_queue), daemon=True)
         try:
-            sqs = boto3.client('sqs')
-            dynamo = boto3.resource('dynamodb')
-            compare_map = {}
-            n = len(self.ids)
-            time_slept = 0
-            while len(self.ids) > 0:
-                response = sqs.receive_message(
-                    QueueUrl=self.completion_queue_url,
-                    AttributeNames=['SentTimestamp'],
-                    MaxNumberOfMessages=10,
-                    MessageAttributeNames=['All'],
-                    VisibilityTimeout=30,
-                    WaitTimeSeconds=0
-                )
-                if 'Messages' not in response:
-                    if time_slept > self.idle_threshold:
+            for w in workers:
+                w.start()
+            deleter.start()
+            while self.remaining() > 0:
+                try:
+                    items, messages = fetched_queue.get(timeout=1)
+                except queue.Empty:
+                    if time.time() - self.last_received > self.idle_threshold:
                         print("No new messages come in within %d seconds, terminating..." % self.idle_threshold)
                         break
-                    time_slept += 1
-                    time.sleep(1)
                     continue
-                time_slept = 0
-                messages = response['Messages']
-                messages_to_delete = []
-                rids = []
-                for m in messages:
-                    messages_to_delete.append((m['MessageId'], m['ReceiptHandle']))
-                    rids.append(m['Body'])
-
-                db_response = dynamo.meta.client.batch_get_item(
-                    RequestItems={
-                        'backtesting-result': {
-                            'Keys': [{'result_id': rid} for rid in rids]
-                        }
-                    }
-                )
-                for item in db_response['Responses']['backtesting-result']:
-                    if item['data_id'] not in self.ids:
-                        continue
-                    if item['data_id'] not in compare_map:
-                        compare_map[item['data_id']] = {}
-                    compare_map[item['data_id']][item['exec_type']] = item['data']
-                    if 'test' in compare_map[item['data_id']] and 'benchmark' in compare_map[item['data_id']]:
-                        comparator.compare(compare_map[item['data_id']]['benchmark'], compare_map[item['data_id']]['test'])
-                        self.ids.remove(item['data_id'])
+                # ids are only checkpointed once their diffs are in delta
+                batch_finished = {v: [] for v in self.variants}
+                pairs = self.pairs(items, stores, batch_finished)
+                with self.metrics.timed('reducer.compare'):
+                    for v, variant_pairs in pairs.items():
+                        delta[v].compare_batch(variant_pairs)
+                for v, ids in batch_finished.items():
+                    finished[v].extend(ids)
+                self.metrics.completed(sum(len(p) for p in pairs.values()))
+                delete_queue.put(messages)
+                print("%d / %d tasks processed" % (n - self.remaining(), n), end='\r')
+                if self.checkpoint is not None and time.time() - last_checkpoint > self.checkpoint_interval:
+                    self.checkpoint.append(delta, finished)
+                    for v in self.variants:
+                        comparators[v].merge(delta[v])
+                    delta = self.comparators()
+                    finished = {v: [] for v in self.variants}
+                    last_checkpoint = time.time()
+                if self.early_stop is not None and time.time() - last_check > self.early_stop.CHECK_INTERVAL:
+                    last_check = time.time()
+                    if self.decide(comparators, delta):
+                        break
+        finally:
+            self.stop.set()
+            for w in workers:
+                w.join()
+            # flush the remaining deletions
+            delete_queue.put(None)
+            deleter.join()
+            if self.checkpoint is not None:
+                self.checkpoint.append(delta, finished)
+            for v in self.variants:
+                comparators[v].merge(delta[v])
+                stores[v].close()
+            print("")
+            end = time.time()
+            print("Process time: " + time.strftime("%H:%M:%S", time.gmtime(end - start)))
+            self.print_report(comparators, stores)
+            for v, (decision, reason) in self.decisions.items():
+                print("Stopped early: %s%s, %s" % (decision.upper(), self.variant_label(v), reason))
 
-                sqs.delete_message_batch(
-                    Entries=[{'Id': i, 'ReceiptHandle': rh} for i, rh in messages_to_delete],
-                    QueueUrl=self.completion_queue_url
-                )
-                print("%d / %d tasks processed" % (n-len(self.ids), n), end='\r')
+    def harvest(self):
+        """ compare the task's results read with parallel segmented scans of the result table instead of
+            the completion queue, for runs that are fully written or whose queue is lost,
+            returns the data ids with a missing benchmark or test result """
+        start = time.time()
+        comparators = self.comparators()
+        self.metrics = ReduceMetrics()
+        dynamo = self.dynamo if self.dynamo is not None else boto3.resource('dynamodb')
+        if self.checkpoint is not None:
+            self.checkpoint.reset()
+        self.stop = threading.Event()
+        pages = queue.Queue(self.reducer_queue_size)
+        scanners = [threading.Thread(target=self.scan, args=(dynamo, segment, pages), daemon=True)
+                    for segment in range(self.harvest_segments)]
+        self.scan_errors = []
+        stores = self.pairing_stores()
+        finished = {v: [] for v in self.variants}
+        n = self.remaining()
+        scanned = 0
+        try:
+            for s in scanners:
+                s.start()
+            done = 0
+            while done < len(scanners):
+                page = pages.get()
+                if page is None:
+                    done += 1
+                    continue
+                scanned += len(page)
+                # results are paired as they arrive, whichever segment they come from
+                pairs = self.pairs(page, stores, finished)
+                with self.metrics.timed('reducer.compare'):
+                    for v, variant_pairs in pairs.items():
+                        comparators[v].compare_batch(variant_pairs)
+                self.metrics.completed(sum(len(p) for p in pairs.values()))
+                print("%d results scanned, %d / %d tasks processed" % (scanned, n - self.remaining(), n), end='\r')
         finally:
+            self.stop.set()
+            for s in scanners:
+                s.join()
+            if self.checkpoint is not None:
+                self.checkpoint.append(comparators, finished)
+            for store in stores.values():
+                store.close()
             print("")
             end = time.time()
             print("Process time: " + time.strftime("%H:%M:%S", time.gmtime(end - start)))
-            comparator.aggregate_and_print()
+            self.print_report(comparators, stores)
+        if len(self.scan_errors) > 0:
+            segment, e = self.scan_errors[0]
+            raise RuntimeError('%d scan segments failed, the harvest is incomplete' % len(self.scan_errors)) from e
+        missing = sorted(set(i for p in self.pending.values() for i in p))
+        if len(missing) > 0:
+            print("%d data ids have no benchmark or test result: %s" % (len(missing), ','.join(missing[:10])))
+        return missing
+
+    def variant_label(self, variant):
+        return '' if len(self.variants) == 1 else ' (%s)' % variant
+
+    def print_report(self, comparators, stores):
+        for v in self.variants:
+            if len(self.variants) > 1:
+                print("Variant %s:" % v)
+            comparators[v].aggregate_and_print()
+        if len(self.variants) > 1:
+            Comparator.print_side_by_side(comparators)
+        self.metrics.print()
+        for v in self.variants:
+            if len(self.variants) > 1:
+                print("Variant %s:" % v)
+            stores[v].print_stats()
+        if self.metrics_path is not None:
+            self.metrics.export(self.metrics_path)
+
+    def scan(self, dynamo, segment, out_queue):
+        """ page through one scan segment, the task's results and its cached benchmark results are kept """
+        expression = 'task_id = :task_id'
+        values = {':task_id': self.task_id}
+        if self.benchmark_cache_key is not None:
+            expression += ' OR begins_with(result_id, :cache_prefix)'
+            values[':cache_prefix'] = result_id_prefix(self.task_id, 'benchmark', self.benchmark_cache_key)
+        request = {'TableName': Reducer.RESULT_TABLE, 'Segment': segment, 'TotalSegments': self.harvest_segments,
+                   'FilterExpression': expression, 'ExpressionAttributeValues': values}
+        try:
+            while not self.stop.is_set():
+                # throttled scans are retried by botocore
+                with self.metrics.timed('reducer.scan'):
+                    response = dynamo.meta.client.scan(**request)
+                if len(response['Items']) > 0:
+                    self.put(out_queue, response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except Exception as e:
+            self.scan_errors.append((segment, e))
+        finally:
+            self.put(out_queue, None)
+
+    def decide(self, comparators, delta):
+        """ check the early stop of every undecided variant on the results so far,
+            stops the work once all variants are decided """
+        for v in self.variants:
+            if v in self.decisions:
+                continue
+            current = Comparator()
+            current.merge(comparators[v])
+            current.merge(delta[v])
+            decision = self.early_stop.decide(current, v)
+            if decision is None:
+                continue
+            self.decisions[v] = (decision, self.early_stop.reason)
+            print("")
+            print("Decided after %d test cases: %s%s, %s"
+                  % (current.total_test_cases, decision.upper(), self.variant_label(v), self.early_stop.reason))
+        if len(self.decisions) < len(self.variants):
+            return False
+        if self.stop_work is not None:
+            self.stop_work()
+        return True
+
+    def pairing_stores(self):
+        return {v: PairingStore(self.pending[v], self.pairing_memory_mb, self.pairing_spill_dir) for v in self.variants}
+
+    def pairs(self, items, stores, finished):
+        """ {variant: (benchmark, test) outputs} of the data ids whose results are both in, the ids are moved
+            from the variant's pending ids to finished, single results wait in the variant's pairing store.
+            A benchmark result is offered to every variant still waiting for it. """
+        pairs = {v: [] for v in self.variants}
+        for item in items:
+            exec_type = item['exec_type']
+            for v in (self.variants if exec_type == 'benchmark' else [exec_type]):
+                if v not in self.pending:
+                    continue
+                i = self.pending[v].index(item['data_id'])
+                if i < 0:
+                    continue
+                pair = stores[v].add(i, exec_type, item['data'])
+                if pair is not None:
+                    pairs[v].append(pair)
+                    self.pending[v].remove_index(i)
+                    finished[v].append(item['data_id'])
+        return pairs
+
+    def read_missing(self, dynamo, comparators, stores, finished):
+        """ compare the results of the missing ids that are already in the result table """
+        # the cached benchmark results are added by with_cached
+        benchmark_prefix = result_id_prefix(self.task_id, 'benchmark') if self.benchmark_cache_key is None else None
+        missing = {v: list(self.pending[v]) for v in self.variants}
+        n = self.remaining()
+        read = 0
+        for v in self.variants:
+            test_prefix = result_id_prefix(self.task_id, v)
+            for x in range(0, len(missing[v]), Reducer.READ_MISSING_BATCH_SIZE):
+                chunk = missing[v][x:x + Reducer.READ_MISSING_BATCH_SIZE]
+                result_ids = [test_prefix + i for i in chunk]
+                if benchmark_prefix is not None:
+                    result_ids += [benchmark_prefix + i for i in chunk]
+                pairs = self.pairs(self.batch_get(dynamo, self.with_cached(result_ids)), stores, finished)
+                for variant, variant_pairs in pairs.items():
+                    comparators[variant].compare_batch(variant_pairs)
+                read += len(chunk)
+                print("%d / %d missing ids read" % (read, n), end='\r')
+        print("")
+        print("%d missing ids read from the result table" % sum(len(f) for f in finished.values()))
+
+    def receive(self, sqs, out_queue):
+        while not self.stop.is_set():
+            receive_start = time.time()
+            response = sqs.receive_message(
+                QueueUrl=self.completion_queue_url,
+                AttributeNames=['SentTimestamp'],
+                MaxNumberOfMessages=10,
+                MessageAttributeNames=['All'],
+                VisibilityTimeout=max(30, self.idle_threshold),
+                WaitTimeSeconds=1
+            )
+            if 'Messages' not in response:
+                continue
+            self.last_received = time.time()
+            self.metrics.add('reducer.receive', self.last_received - receive_start)
+            self.metrics.add_messages(response['Messages'], self.last_received)
+            self.put(out_queue, response['Messages'])
+
+    def fetch(self, dynamo, in_queue, out_queue):
+        while not self.stop.is_set():
+            try:
+                messages = list(in_queue.get(timeout=0.5))
+            except queue.Empty:
+                continue
+            result_ids = {m['MessageId']: Reducer.result_ids(m['Body']) for m in messages}
+            n = sum(len(r) for r in result_ids.values())
+            # coalesce whatever else is already received up to the batch_get_item key limit
+            while n < Reducer.FETCH_BATCH_SIZE:
+                try:
+                    more = in_queue.get_nowait()
+                except queue.Empty:
+                    break
+                for m in more:
+                    result_ids[m['MessageId']] = Reducer.result_ids(m['Body'])
+                    n += len(result_ids[m['MessageId']])
+                messages.extend(more)
+            with self.metrics.timed('reducer.fetch'):
+                items = self.batch_get(dynamo, self.with_cached([rid for rids in result_ids.values() for rid in rids]))
+            # messages with a result that can not be read yet are not deleted, so they are delivered again
+            found = set(item['result_id'] for item in items)
+            self.put(out_queue, (items, [m for m in messages if all(rid in found for rid in result_ids[m['MessageId']])]))
+
+    def with_cached(self, result_ids):
+        """ add the cached benchmark result ids of the data ids of test results """
+        if self.benchmark_cache_key is None:
+            return result_ids
+        cache_prefix = result_id_prefix(self.task_id, 'benchmark', self.benchmark_cache_key)
+        cached = []
+        for v in self.variants:
+            test_prefix = result_id_prefix(self.task_id, v)
+            cached += [cache_prefix + rid[len(test_prefix):] for rid in result_ids if rid.startswith(test_prefix)]
+        return result_ids + cached
+
+    @staticmethod
+    def result_ids(body):
+        """ a completion message carries one result id, or a JSON list of them for a shard """
+        if body.startswith('['):
+            return json.loads(body)
+        return [body]
+
+    def batch_get(self, dynamo, result_ids):
+        items = []
+        unique_ids = list(dict.fromkeys(result_ids))
+        for x in range(0, len(unique_ids), Reducer.FETCH_BATCH_SIZE):
+            request = {Reducer.RESULT_TABLE: {'Keys': [{'result_id': rid} for rid in unique_ids[x:x + Reducer.FETCH_BATCH_SIZE]]}}
+            for attempt in range(Reducer.MAX_RETRIES):
+                response = dynamo.meta.client.batch_get_item(RequestItems=request)
+                items.extend(response['Responses'].get(Reducer.RESULT_TABLE, []))
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+                time.sleep(min(0.05 * (2 ** attempt), 2))
+        return items
+
+    def delete(self, sqs, in_queue):
+        while True:
+            messages = in_queue.get()
+            if messages is None:
+                return
+            for x in range(0, len(messages), 10):
+                sqs.delete_message_batch(
+                    Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages[x:x + 10])],
+                    QueueUrl=self.completion_queue_url
+                )
+
+    def put(self, out_queue, value):
+        """ blocking put that gives up once the pipeline is stopped """
+        while not self.stop.is_set():
+            try:
+                out_queue.put(value, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+class ReduceMetrics:
+    """Latency distributions of the handler stages (from the completion messages' timings attribute),
+       the completion queue lag and the reducer's own stages, plus results/sec over time"""
+    THROUGHPUT_INTERVAL = 10
+    # invocation ids remembered to count the stages shared by the messages of one invocation once
+    MAX_INVOCATIONS = 100000
+
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.stats = {}
+        self.throughput = {}
+        self.cold_starts = 0
+        # dict as an insertion-ordered set of the most recent invocation ids
+        self.invocations = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = FieldStats()
+            self.stats[name].add(np.array([seconds], dtype=float))
+
+    def timed(self, name):
+        return _Timer(self, name)
+
+    def add_messages(self, messages, received_at):
+        for m in messages:
+            if 'SentTimestamp' in m.get('Attributes', {}):
+                self.add('queue.lag', received_at - int(m['Attributes']['SentTimestamp']) / 1000.0)
+            timings = m.get('MessageAttributes', {}).get('timings')
+            if timings is None:
+                continue
+            timings = json.loads(timings['StringValue'])
+            n = len(Reducer.result_ids(m['Body']))
+            if 'run' in timings:
+                self.add('handler.run_per_record', timings['run'] / max(1, n))
+            # fetch, write and the cold start are shared by the messages of an invocation, older handlers and the
+            # local backend send no invocation id and one message per invocation
+            if not self.first_of_invocation(timings.get('invocation', m.get('MessageId'))):
+                continue
+            for stage in ('fetch', 'write'):
+                if stage in timings:
+                    self.add('handler.' + stage, timings[stage])
+            if timings.get('cold_start'):
+                self.add('handler.init', timings['init'])
+                with self.lock:
+                    self.cold_starts += 1
+
+    def first_of_invocation(self, invocation):
+        if invocation is None:
+            return True
+        with self.lock:
+            if invocation in self.invocations:
+                return False
+            self.invocations[invocation] = True
+            if len(self.invocations) > ReduceMetrics.MAX_INVOCATIONS:
+                del self.invocations[next(iter(self.invocations))]
+            return True
+
+    def completed(self, n):
+        now = time.time()
+        bucket = int((now - self.start) // ReduceMetrics.THROUGHPUT_INTERVAL)
+        with self.lock:
+            self.throughput[bucket] = self.throughput.get(bucket, 0) + n
+            self.last = max(self.last, now)
+
+    def interval_seconds(self, bucket):
+        """ the last bucket only covers the time up to the last result """
+        if bucket < max(self.throughput, default=0):
+            return ReduceMetrics.THROUGHPUT_INTERVAL
+        return max(1e-3, self.last - self.start - bucket * ReduceMetrics.THROUGHPUT_INTERVAL)
+
+    def print(self):
+        if len(self.stats) == 0:
+            return
+        print("Stage latencies (seconds):")
+        print("{0:>30} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10}".format("stage", "count", "mean", "p50", "p95", "p99"))
+        for k, v in sorted(self.stats.items()):
+            print("{0:>30} {1:>10} {2:>10.4f} {3:>10.4f} {4:>10.4f} {5:>10.4f}".format(
+                k, v.count, v.mean, v.quantile(0.5), v.quantile(0.95), v.quantile(0.99)))
+        print("Cold starts: %d" % self.cold_starts)
+        print("Throughput:")
+        for bucket in sorted(self.throughput):
+            print("{0:>10} {1:>10.1f} results/sec".format(
+                "%ds" % (bucket * ReduceMetrics.THROUGHPUT_INTERVAL), self.throughput[bucket] / self.interval_seconds(bucket)))
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'stages': {k: {'count': v.count, 'mean': v.mean, 'min': v.min, 'max': v.max, 'p50': v.quantile(0.5),
+                               'p95': v.quantile(0.95), 'p99': v.quantile(0.99)} for k, v in self.stats.items()},
+                'cold_starts': self.cold_starts,
+                'throughput_interval': ReduceMetrics.THROUGHPUT_INTERVAL,
+                # the last interval is shorter, it ends with the last result
+                'elapsed': self.last - self.start,
+                'throughput': [self.throughput.get(b, 0) for b in range(max(self.throughput, default=-1) + 1)]
+            }, f, indent=2)
+
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.add(self.name, time.time() - self.start)
+        return False
 
 
 class Comparator:
     def __init__(self):
         self.total_test_cases = 0
         self.total_test_cases_with_diffs = 0
-        self.field_diffs = {}
+        self.field_stats = {}
 
     def compare(self, a, b):
         """This is a simplified comparing function and can only handle numerical values"""
-        a_map = Comparator.flatten(a)
-        b_map = Comparator.flatten(b)
-        a_only = set(a_map) - set(b_map)
-        b_only = set(b_map) - set(a_map)
-
-        result = {}
-        for k in set(a_map).intersection(set(b_map)):
-            if a_map[k] != b_map[k]:
-                result[k] = b_map[k] - a_map[k]
-        for k in a_only:
-            result[k] = 'deleted'
-        for k in b_only:
-            result[k] = 'added'
-
-        for k, v in result.items():
-            if k not in self.field_diffs:
-                self.field_diffs[k] = []
-            self.field_diffs[k].append(v)
-
-        self.total_test_cases += 1
-        if len(result) > 0:
-            self.total_test_cases_with_diffs += 1
+        self.compare_batch([(a, b)])
+
+    def compare_batch(self, pairs):
+        """ compare a batch of (benchmark, test) outputs in one vectorized pass,
+            outputs can be nested dicts or blobs in the compact result format (see workflow.result_codec) """
+        if len(pairs) == 0:
+            return
+        a_rows = [Comparator.to_row(p[0]) for p in pairs]
+        b_rows = [Comparator.to_row(p[1]) for p in pairs]
+        keys, a, a_mask = Comparator.to_arrays(a_rows)
+        b_keys, b, b_mask = Comparator.to_arrays(b_rows, keys)
+        # b_keys extends keys with the fields only present in test outputs
+        a = np.pad(a, ((0, 0), (0, len(b_keys) - len(keys))))
+        a_mask = np.pad(a_mask, ((0, 0), (0, len(b_keys) - len(keys))))
+        other_diffs = self.compare_others(b_keys, a_rows, b_rows, a_mask, b_mask)
+        self.compare_arrays(b_keys, a, b, a_mask, b_mask, other_diffs)
+
+    def compare_others(self, keys, a_rows, b_rows, a_mask, b_mask):
+        """ compare the non-numeric fields (labels, None, lists) of each case by equality, a field that is numeric
+            on one side only counts as changed and is taken out of the masks of the numeric comparison;
+            returns which cases have such a difference """
+        diffs = np.zeros(len(a_rows), dtype=bool)
+        index = None
+        for i, (a_row, b_row) in enumerate(zip(a_rows, b_rows)):
+            a_others, b_others = a_row[2], b_row[2]
+            if len(a_others) == 0 and len(b_others) == 0:
+                continue
+            if index is None:
+                index = {k: j for j, k in enumerate(keys)}
+            for k in set(a_others) | set(b_others):
+                j = index.get(k)
+                if k in a_others and k in b_others:
+                    if a_others[k] == b_others[k]:
+                        continue
+                    kind = 'changed'
+                elif j is not None and (a_mask[i, j] or b_mask[i, j]):
+                    # numeric on the other side
+                    a_mask[i, j] = b_mask[i, j] = False
+                    kind = 'changed'
+                else:
+                    kind = 'deleted' if k in a_others else 'added'
+                if k not in self.field_stats:
+                    self.field_stats[k] = FieldStats()
+                setattr(self.field_stats[k], kind, getattr(self.field_stats[k], kind) + 1)
+                diffs[i] = True
+        return diffs
+
+    def compare_arrays(self, keys, a, b, a_mask=None, b_mask=None, other_diffs=None):
+        """ compare n cases given as (n, len(keys)) float arrays, masks tell which fields exist in each case,
+            other_diffs which cases differ in their non-numeric fields """
+        if a_mask is None:
+            a_mask = np.ones(a.shape, dtype=bool)
+        if b_mask is None:
+            b_mask = np.ones(b.shape, dtype=bool)
+        changed = a_mask & b_mask & (a != b)
+        deleted = a_mask & ~b_mask
+        added = b_mask & ~a_mask
+        with_diffs = (changed | deleted | added).any(axis=1)
+        if other_diffs is not None:
+            with_diffs |= other_diffs
+        self.total_test_cases += a.shape[0]
+        self.total_test_cases_with_diffs += int(with_diffs.sum())
+
+        diffs = b - a
+        for j in np.flatnonzero((changed | deleted | added).any(axis=0)):
+            k = keys[j]
+            if k not in self.field_stats:
+                self.field_stats[k] = FieldStats()
+            stats = self.field_stats[k]
+            stats.add(diffs[changed[:, j], j])
+            stats.added += int(added[:, j].sum())
+            stats.deleted += int(deleted[:, j].sum())
+
+    def merge(self, other):
+        """ combine the state of a comparator that reduced another part of the same task """
+        self.total_test_cases += other.total_test_cases
+        self.total_test_cases_with_diffs += other.total_test_cases_with_diffs
+        for k, v in other.field_stats.items():
+            if k not in self.field_stats:
+                self.field_stats[k] = FieldStats()
+            self.field_stats[k].merge(v)
 
     @staticmethod
     def flatten(target):
         """This is a simplified flatten method that only handles nested dicts"""
-        results = {}
-
-        def visit(obj, curr_str):
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    new_str = k if curr_str == '' else curr_str + '.' + k
-                    visit(v, new_str)
-            else:
-                results[curr_str] = obj
-        visit(target, '')
-        return results
+        return result_codec.flatten(target)
+
+    @staticmethod
+    def to_row(output):
+        """ (keys, values, others) of one output: the numeric fields as keys and a values array, the other fields
+            as a dict, encoded results are decoded without flattening """
+        if result_codec.is_encoded(output):
+            return result_codec.decode(output) + ({},)
+        flat = Comparator.flatten(output)
+        numeric = {k: v for k, v in flat.items() if isinstance(v, numbers.Number) and not isinstance(v, complex)}
+        others = {k: v for k, v in flat.items() if k not in numeric} if len(numeric) < len(flat) else {}
+        return tuple(numeric), np.array([float(v) for v in numeric.values()]), others
+
+    @staticmethod
+    def to_arrays(rows, keys=None):
+        """ turn (keys, values, ...) rows into a values array and a presence mask over a shared list of keys,
+            rows with the same keys are copied together """
+        keys = list(keys or [])
+        index = {k: j for j, k in enumerate(keys)}
+        schemas = {}
+        for i, row in enumerate(rows):
+            row_keys = row[0]
+            schemas.setdefault(row_keys, []).append(i)
+            for k in row_keys:
+                if k not in index:
+                    index[k] = len(keys)
+                    keys.append(k)
+        values = np.zeros((len(rows), len(keys)))
+        mask = np.zeros((len(rows), len(keys)), dtype=bool)
+        for row_keys, row_indices in schemas.items():
+            if len(row_keys) == 0:
+                continue
+            columns = np.array([index[k] for k in row_keys])
+            selector = np.ix_(row_indices, columns)
+            values[selector] = np.vstack([rows[i][1] for i in row_indices])
+            mask[selector] = True
+        return keys, values, mask
 
     def aggregate_and_print(self):
         print("Total test cases: %d" % self.total_test_cases)
         print("Total test cases with differences: %d" % self.total_test_cases_with_diffs)
         if self.total_test_cases_with_diffs > 0:
             print("Changes in output:")
-            print("{0:>30} {1:>10} {2:>10}".format("name", "diff_mean", "count"))
-            str_format = "{0:>30} {1:>10.2f} {2:>10}"
-            import numpy as np
-            for k, v in self.field_diffs.items():
-                if isinstance(v[0], str):
-                    diff_mean = ''
+            print("{0:>30} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10} {8:>10} {9:>10}".format(
+                "name", "count", "diff_mean", "diff_std", "min", "p50", "p95", "max", "added", "deleted"))
+            str_format = "{0:>30} {1:>10} {2:>10.2f} {3:>10.2f} {4:>10.2f} {5:>10.2f} {6:>10.2f} {7:>10.2f} {8:>10} {9:>10}"
+            empty_format = "{0:>30} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>10} {8:>10} {9:>10}"
+            for k, v in self.field_stats.items():
+                if v.count == 0:
+                    # non-numeric fields are only counted
+                    print(empty_format.format(k, v.changed, '', '', '', '', '', '', v.added, v.deleted))
                 else:
-                    diff_mean = np.mean(v)
-                print(str_format.format(k, diff_mean, len(v)))
+                    print(str_format.format(k, v.count, v.mean, v.std, v.min, v.quantile(0.5), v.quantile(0.95),
+                                            v.max, v.added, v.deleted))
+
+    @staticmethod
+    def print_side_by_side(comparators):
+        """ one column per variant: the diff rate and the mean diff of every changed field """
+        names = list(comparators)
+        print("Side by side:")
+        row_format = "{0:>30}" + "".join(" {%d:>16}" % (i + 1) for i in range(len(names)))
+        print(row_format.format("", *names))
+        print(row_format.format("test cases", *[c.total_test_cases for c in comparators.values()]))
+        print(row_format.format("with differences", *[c.total_test_cases_with_diffs for c in comparators.values()]))
+        print(row_format.format("diff rate", *["%.4f" % (c.total_test_cases_with_diffs / c.total_test_cases)
+                                               if c.total_test_cases > 0 else "" for c in comparators.values()]))
+        fields = sorted(set(k for c in comparators.values() for k in c.field_stats))
+        for k in fields:
+            cells = []
+            for c in comparators.values():
+                v = c.field_stats.get(k)
+                cells.append("" if v is None else "%.2f (%d)" % (v.mean, v.count) if v.count > 0
+                             else "~%d +%d -%d" % (v.changed, v.added, v.deleted))
+            print(row_format.format(k, *cells))
+
+
+class FieldStats:
+    """Constant-memory, mergeable statistics of the diffs of one output field"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.added = 0
+        self.deleted = 0
+        # changes of non-numeric values, which have no diff
+        self.changed = 0
+        self.sketch = QuantileSketch()
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        n = len(values)
+        mean = float(np.mean(values))
+        m2 = float(np.sum((values - mean) ** 2))
+        self._combine(n, mean, m2)
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        self.sketch.add(values)
+
+    def merge(self, other):
+        if other.count > 0:
+            self._combine(other.count, other.mean, other.m2)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.added += other.added
+        self.deleted += other.deleted
+        self.changed += other.changed
+        self.sketch.merge(other.sketch)
+
+    def _combine(self, n, mean, m2):
+        """ Chan et al. parallel update of count, mean and sum of squared deviations """
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    def quantile(self, q):
+        return min(max(self.sketch.quantile(q), self.min), self.max)
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with logarithmic buckets (values are estimated within relative_accuracy)"""
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.zeros += int(np.count_nonzero(values == 0))
+        self._add_buckets(self.positive, values[values > 0])
+        self._add_buckets(self.negative, -values[values < 0])
+        self.count += len(values)
+
+    def _add_buckets(self, buckets, values):
+        if len(values) == 0:
+            return
+        indices, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for i, c in zip(indices.tolist(), counts.tolist()):
+            buckets[i] = buckets.get(i, 0) + c
+
+    def merge(self, other):
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for i, c in other_buckets.items():
+                buckets[i] = buckets.get(i, 0) + c
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float('nan')
+        rank = q * (self.count - 1)
+        seen = 0
+        # walk the buckets from the most negative value to the largest positive one
+        for i in sorted(self.negative, reverse=True):
+            seen += self.negative[i]
+            if seen > rank:
+                return -self._bucket_value(i)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return self._bucket_value(i)
+        return self._bucket_value(max(self.positive)) if self.positive else 0.0
+
+    def _bucket_value(self, i):
+        return 2 * self.gamma ** i / (self.gamma + 1)
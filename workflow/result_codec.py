@@ -0,0 +1,64 @@
+"""Compact result format: a model output flattened to dotted keys and stored as float64 values.
+
+Outputs with a non-numeric leaf (strings, lists, None) cannot be encoded; encode returns None for them and the
+caller stores the DynamoDB map instead.
+
+Layout: MAGIC, one flag byte (1 = zlib compressed) and the body
+<uint32 header length><JSON list of keys><little-endian float64 values>.
+Only the standard library is used for encoding, so this module is copied next to the generated
+Lambda handler; decoding into NumPy arrays happens in the reducer.
+"""
+import json
+import numbers
+import struct
+import zlib
+
+MAGIC = b'BTR1'
+COMPRESSED = 1
+
+
+def flatten(target):
+    """This is a simplified flatten method that only handles nested dicts"""
+    results = {}
+
+    def visit(obj, curr_str):
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                new_str = k if curr_str == '' else curr_str + '.' + k
+                visit(v, new_str)
+        else:
+            results[curr_str] = obj
+    visit(target, '')
+    return results
+
+
+def encode(output, compress=True):
+    """ returns the encoded output, or None when a leaf is not a real number """
+    flat = flatten(output)
+    if not all(isinstance(v, numbers.Number) and not isinstance(v, complex) for v in flat.values()):
+        return None
+    header = json.dumps(list(flat)).encode()
+    body = struct.pack('<I', len(header)) + header + struct.pack('<%dd' % len(flat), *[float(v) for v in flat.values()])
+    if compress:
+        return MAGIC + bytes([COMPRESSED]) + zlib.compress(body)
+    return MAGIC + bytes([0]) + body
+
+
+def is_encoded(data):
+    # boto3 returns binary attributes wrapped in boto3.dynamodb.types.Binary
+    data = getattr(data, 'value', data)
+    return isinstance(data, (bytes, bytearray)) and data[:len(MAGIC)] == MAGIC
+
+
+def decode(data):
+    """ returns the tuple of keys and a float64 NumPy array of the values """
+    import numpy as np
+    data = bytes(getattr(data, 'value', data))
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not an encoded result')
+    body = data[len(MAGIC) + 1:]
+    if data[len(MAGIC)] & COMPRESSED:
+        body = zlib.decompress(body)
+    header_length, = struct.unpack_from('<I', body)
+    keys = tuple(json.loads(body[4:4 + header_length]))
+    return keys, np.frombuffer(body, dtype='<f8', offset=4 + header_length, count=len(keys))
@@ -0,0 +1,105 @@
+"""Early-stop sampling: the work is triggered in a stratified random order, so the results that arrive first are a
+growing stratified sample, and the reduce stops the run as soon as the sample decides whether the test model
+differs from the benchmark beyond the task's thresholds.
+"""
+import math
+import random
+from statistics import NormalDist
+
+PASS = 'pass'
+FAIL = 'fail'
+
+
+def stratified_order(items, strata=10, seed=0):
+    """ items reordered so that every prefix is a stratified random sample: the items are split into strata
+        contiguous blocks (e.g. periods of the historical data), each block is shuffled and the blocks are
+        taken from in turn """
+    rng = random.Random(seed)
+    n = len(items)
+    if n == 0:
+        return []
+    strata = max(1, min(strata, n))
+    blocks = [list(items[n * s // strata:n * (s + 1) // strata]) for s in range(strata)]
+    for b in blocks:
+        rng.shuffle(b)
+    return [b[i] for i in range(max(len(b) for b in blocks)) for b in blocks if i < len(b)]
+
+
+def wilson_interval(k, n, z):
+    """ confidence interval of a rate of k in n """
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class EarlyStop:
+    """Decides a sampled run from a Comparator's state, 'sampling' in task_config.json:
+       max_diff_rate: share of test cases allowed to differ, max_field_diff: optional bound of the mean diff of
+       every field, confidence of the bounds over all looks, min_sample: test cases compared before the first look,
+       max_looks: number of looks, the k-th one once min_sample * look_growth ** k cases are compared.
+       The intervals are only checked at these looks, each at confidence 1 - (1 - confidence) / max_looks
+       (Bonferroni), so that looking again as the sample grows does not raise the error rate."""
+    # seconds between two checks of the reducer's state
+    CHECK_INTERVAL = 1
+
+    def __init__(self, max_diff_rate=0.01, max_field_diff=None, confidence=0.99, min_sample=1000, strata=10,
+                 max_looks=8, look_growth=2):
+        self.max_diff_rate = max_diff_rate
+        self.max_field_diff = max_field_diff
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf(1 - (1 - confidence) / (2 * max_looks))
+        self.min_sample = min_sample
+        self.strata = strata
+        self.max_looks = max_looks
+        self.look_growth = look_growth
+        # {key: index of the last look taken}
+        self.looks = {}
+        self.reason = None
+
+    def look(self, n):
+        """ index of the last look reached with n test cases, -1 before the first """
+        if n < self.min_sample:
+            return -1
+        k = 0
+        while k + 1 < self.max_looks and n >= self.min_sample * self.look_growth ** (k + 1):
+            k += 1
+        return k
+
+    def decide(self, comparator, key=None):
+        """ PASS, FAIL or None while undecided or between looks, the reason is kept in self.reason;
+            key: the looks are counted per key, e.g. per test variant """
+        n = comparator.total_test_cases
+        look = self.look(n)
+        if look <= self.looks.get(key, -1):
+            return None
+        self.looks[key] = look
+        low, high = wilson_interval(comparator.total_test_cases_with_diffs, n, self.z)
+        if low > self.max_diff_rate:
+            self.reason = "diff rate is above %.4f (%.4f-%.4f at %.0f%% confidence, %d cases, look %d of %d)" \
+                          % (self.max_diff_rate, low, high, self.confidence * 100, n, look + 1, self.max_looks)
+            return FAIL
+        fields_decided = True
+        if self.max_field_diff is not None:
+            for k, v in comparator.field_stats.items():
+                if v.count == 0:
+                    # non-numeric or only added / deleted, covered by the diff rate
+                    continue
+                if v.count < 2:
+                    fields_decided = False
+                    continue
+                half = self.z * v.std / math.sqrt(v.count)
+                if abs(v.mean) - half > self.max_field_diff:
+                    self.reason = "mean diff of %s is above %g (%.4g +- %.4g at %.0f%% confidence, look %d of %d)" \
+                                  % (k, self.max_field_diff, v.mean, half, self.confidence * 100, look + 1,
+                                     self.max_looks)
+                    return FAIL
+                if abs(v.mean) + half > self.max_field_diff:
+                    fields_decided = False
+        if high <= self.max_diff_rate and fields_decided:
+            self.reason = "diff rate is below %.4f (%.4f-%.4f at %.0f%% confidence, %d cases, look %d of %d)" \
+                          % (self.max_diff_rate, low, high, self.confidence * 100, n, look + 1, self.max_looks)
+            return PASS
+        return None
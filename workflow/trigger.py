@@ -1,25 +1,138 @@
 import boto3
+import json
+import time
 import uuid
+import threading
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
+
+from workflow.sampling import stratified_order
 
 
 class Trigger:
-    def run(self, data_ids, queue_urls):
-        sqs = boto3.client('sqs')
+    MAX_RETRIES = 8
+    # send_message_batch takes up to 10 entries and 256KB in total
+    MAX_BATCH_BYTES = 262144
+
+    def __init__(self, parallelism=16, sqs=None, shard_size=1, sample_strata=None):
+        self.parallelism = parallelism
+        # number of data ids packed into one message, processed by the handler as one unit
+        self.shard_size = shard_size
+        # send the work units in a stratified random order, so the first results are a sample (see workflow.sampling)
+        self.sample_strata = sample_strata
+        # boto3 clients are thread-safe, so one client is shared by every sender thread
+        self.sqs = sqs
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = []
+
+    def run(self, data_ids, queue_urls, skip=None):
+        """ skip: optional {queue url: data ids not to send to it}, e.g. ids with a cached benchmark result """
+        skip = skip or {}
+        jobs = []
+        for qu in queue_urls:
+            ids = [i for i in data_ids if i not in skip[qu]] if qu in skip else data_ids
+            jobs.append((qu, self.order(self.work_units(ids)), len(ids)))
+        return self.send(jobs)
+
+    def run_rows(self, n_rows, queue_urls, skip=None):
+        """ trigger every row of the EFS dataset (see workflow.dataset) with messages referring to row ranges,
+            skip: optional {queue url: row indices not to send to it} """
+        skip = skip or {}
+        jobs = []
+        for qu in queue_urls:
+            ranges = Trigger.row_ranges(n_rows, skip.get(qu, ()), max(1, self.shard_size))
+            jobs.append((qu, self.order([json.dumps({'rows': [a, b]}) for a, b in ranges]), sum(b - a for a, b in ranges)))
+        return self.send(jobs)
+
+    @staticmethod
+    def row_ranges(n_rows, skip_rows, size):
+        """ [start, end) ranges of at most size rows covering the rows not in skip_rows """
+        ranges = []
+        start = None
+        for row in range(n_rows + 1):
+            if row < n_rows and row not in skip_rows:
+                if start is None:
+                    start = row
+                if row + 1 - start < size:
+                    continue
+                ranges.append((start, row + 1))
+            elif start is not None:
+                ranges.append((start, row))
+            start = None
+        return ranges
+
+    def send(self, jobs):
+        """ jobs: (queue url, message bodies, number of ids in the bodies) """
+        sqs = self.sqs if self.sqs is not None else boto3.client('sqs')
+        self.sent = 0
+        self.failed = []
+
+        # chunks for all queues are sent at the same time, taken from the queues in turn so that the benchmark and
+        # test results of the same ids arrive together
+        n = sum(len(bodies) for _, bodies, _ in jobs)
+        n_ids = sum(c for _, _, c in jobs)
+        start = time.time()
+        chunks = zip_longest(*[[(qu, chunk) for chunk in Trigger.batches(bodies)] for qu, bodies, _ in jobs])
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = [executor.submit(self.send_chunk, sqs, qu, chunk)
+                       for turn in chunks for qu, chunk in filter(None, turn)]
+            for f in futures:
+                f.result()
+        elapsed = time.time() - start
+        print("")
+        print("%d / %d events pushed in %.2f seconds (%.1f messages/sec, %.1f ids/sec)"
+              % (self.sent, n, elapsed, self.sent / elapsed if elapsed > 0 else 0,
+                 self.sent * n_ids / n / elapsed if elapsed > 0 and n > 0 else 0))
+        if len(self.failed) > 0:
+            print("%d events could not be pushed: %s" % (len(self.failed), ','.join(i for _, i in self.failed[:10])))
+        return self.sent
+
+    def order(self, bodies):
+        """ the same seed is used for every queue, so benchmark and test work on the same sample first """
+        if self.sample_strata is None:
+            return bodies
+        return stratified_order(bodies, self.sample_strata)
+
+    def work_units(self, data_ids):
+        """ message bodies: a plain data id, or a JSON list of data ids when sharding """
+        if self.shard_size <= 1:
+            return list(data_ids)
+        return [json.dumps(data_ids[x:x + self.shard_size]) for x in range(0, len(data_ids), self.shard_size)]
+
+    @staticmethod
+    def batches(bodies):
+        """ split message bodies into send_message_batch sized chunks """
+        chunk = []
+        size = 0
+        for b in bodies:
+            if len(chunk) == 10 or (len(chunk) > 0 and size + len(b) > Trigger.MAX_BATCH_BYTES):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(b)
+            size += len(b)
+        if len(chunk) > 0:
+            yield chunk
 
-        # each request can only take 10 in a batch
-        n = len(data_ids)
-        for x in range(0, n, 10):
-            if x >= len(data_ids):
+    def send_chunk(self, sqs, queue_url, ids):
+        if queue_url.endswith('.fifo'):
+            pending = {str(uuid.uuid4()): {'MessageGroupId': 'task', 'MessageBody': i} for i in ids}
+        else:
+            pending = {str(uuid.uuid4()): {'MessageBody': i} for i in ids}
+        sent = 0
+        for attempt in range(Trigger.MAX_RETRIES):
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[dict(e, Id=i) for i, e in pending.items()]
+            )
+            sent += len(response.get('Successful', []))
+            # retry only the entries that failed, with exponential backoff
+            pending = {f['Id']: pending[f['Id']] for f in response.get('Failed', [])}
+            if len(pending) == 0:
                 break
-            for qu in queue_urls:
-                if qu.endswith('.fifo'):
-                    entries = [{'MessageGroupId': 'task', 'MessageBody': i, 'Id': str(uuid.uuid4())} for i in data_ids[x:x + 10]]
-                else:
-                    entries = [{'MessageBody': i, 'Id': str(uuid.uuid4())} for i in data_ids[x:x + 10]]
-                response = sqs.send_message_batch(
-                    QueueUrl=qu,
-                    Entries=entries
-                )
-                # print("Sent %d events to %s" % (len(entries), qu))
-                # print(response)
-            print("%d / %d events pushed" % (x + 10, n), end='\r')
+            time.sleep(min(0.05 * (2 ** attempt), 5))
+        with self.lock:
+            self.sent += sent
+            self.failed.extend((queue_url, e['MessageBody']) for e in pending.values())
+            print("%d events pushed" % self.sent, end='\r')
@@ -0,0 +1,27 @@
+"""Test variants: "test" in task_config.json is one package section, or a list of sections with a "name" each.
+
+Every variant is deployed, triggered and reduced as its own exec type "test_<name>" (its own function, work queue
+and result ids) against the one benchmark, which is deployed and run once.
+"""
+BENCHMARK = 'benchmark'
+TEST = 'test'
+
+
+def test_exec_types(task_config):
+    if isinstance(task_config.get(TEST, {}), dict):
+        return [TEST]
+    return [TEST + '_' + v['name'] for v in task_config[TEST]]
+
+
+def exec_types(task_config):
+    return [BENCHMARK] + test_exec_types(task_config)
+
+
+def section(task_config, exec_type):
+    """ the package section (git, branch, python, files) of an exec type """
+    if exec_type in (BENCHMARK, TEST):
+        return task_config[exec_type]
+    for v in task_config[TEST]:
+        if TEST + '_' + v['name'] == exec_type:
+            return v
+    raise KeyError(exec_type)